@@ -5,115 +5,642 @@
 Tools for loading data from CASU logfiles.
 """
 
+import argparse
+import functools
+import itertools
+import multiprocessing
 import sys
 import os
-import csv
 
+import numpy as np
 import scipy.io as sio
 
-def load_from_csv(filepath):
+def casu_name(logpath):
     """
-    Load log data from a csv file.
+    Get the CASU name from the name of a log ('YYYY-MM-DD-HH-MM-SS-name.csv'
+    or 'YYYY-MM-DD-HH-MM-SS-name.bin').
     """
-    data = {}
-
-    filename = os.path.basename(filepath)
-    casu = ''
+    filename = os.path.basename(logpath.rstrip(os.sep))
     if len(filename) < 25:
         sys.exit('{0} is an invalid CASU log file name!.'.format(filename))
-    else:
-        casu = filename[20:-4].replace('-','_')
-        data[casu] = {}
+    return filename[20:-4].replace('-','_')
+
+def _select(times, t_start, t_end, step):
+    """
+    Returns the indices of timestamps within [t_start, t_end),
+    keeping every step-th of them.
+    """
+    keep = np.ones(len(times), dtype=bool)
+    if t_start is not None:
+        keep &= times >= t_start
+    if t_end is not None:
+        keep &= times < t_end
+    return np.flatnonzero(keep)[::step]
+
+def _pad(values, width):
+    """
+    Pad a 2D array with NaN columns up to width.
+    """
+    if values.shape[1] == width:
+        return values
+    padded = np.empty((len(values), width))
+    padded.fill(np.nan)
+    padded[:, :values.shape[1]] = values
+    return padded
+
+def _stack(arrays):
+    """
+    Concatenate 2D arrays of rows, padding the narrower ones with NaN.
+    """
+    width = max([values.shape[1] for values in arrays])
+    return np.concatenate([_pad(values, width) for values in arrays])
+
+def _parse_rows(rows, t_start = None, t_end = None, step = 1):
+    """
+    Convert a list of rows 'timestamp;value;value...' of one data id
+    into a 2D array, with timestamps in the first column.
+
+    Some data ids have rows of different lengths (e.g. the on and off
+    VibrationPattern echoes); shorter rows are padded with NaN.
+
+    All rows are converted in one go; only if that fails,
+    the rows that can not be converted are located and skipped.
+    If a time window or downsampling is requested, only the timestamps
+    are converted first, and the values of rejected rows are never converted.
+    """
+    width = max([row.count(';') for row in rows]) + 1
+    if t_start is not None or t_end is not None or step > 1:
+        times = np.fromstring(';'.join([row[:row.index(';')] for row in rows]), sep=';')
+        if len(times) != len(rows):
+            # Skip the rows with invalid timestamps
+            rows = [row for row in rows
+                    if len(np.fromstring(row[:row.index(';')], sep=';')) == 1]
+            times = np.fromstring(';'.join([row[:row.index(';')] for row in rows]), sep=';')
+        rows = [rows[i] for i in _select(times, t_start, t_end, step)]
+    widths = np.array([row.count(';') + 1 for row in rows], dtype=int)
+    # Parsing stops at the first cell that is not a number
+    values = np.fromstring(';'.join(rows), sep=';')
+    if len(values) != widths.sum():
+        # Accelerometers are currently not providing any data
+        # We don't want to bother users with that
+        rows = [row for row in rows
+                if len(np.fromstring(row, sep=';')) == row.count(';') + 1]
+        widths = np.array([row.count(';') + 1 for row in rows], dtype=int)
+        values = np.fromstring(';'.join(rows), sep=';')
+    if (widths == width).all():
+        return values.reshape(len(rows), width)
+    padded = np.empty((len(rows), width))
+    padded.fill(np.nan)
+    padded[np.arange(width) < widths[:, np.newaxis]] = values
+    return padded
+
+def iter_csv_streams(filepath, streams = None, t_start = None, t_end = None, step = 1,
+                     cache = False):
+    """
+    Iterate over the data ids of a csv log.
+
+    The rows are split by data id in one pass, and
+    each data id is then converted into an array at once.
+    Only one converted data id is held in memory at a time.
+
+    :param list streams: Data ids to load (default: all). Rows of other data ids are skipped without conversion.
+    :param float t_start: Skip rows with timestamps before t_start.
+    :param float t_end: Skip rows with timestamps from t_end on.
+    :param int step: Downsampling factor, keep only every step-th row.
+    :param bool cache: Use a sidecar cache file, see :py:func:`load_cached_csv`.
+                       The selection is then applied to the cached data.
+    :return: A generator of (dataid, timestamps, values) tuples.
+    """
+    if cache:
+        selected = None
+        if streams is not None:
+            selected = set([s.replace('-','_') for s in streams])
+        for (dataid, values) in sorted(load_cached_csv(filepath).items()):
+            if selected is None or dataid in selected:
+                if t_start is not None or t_end is not None or step > 1:
+                    values = values[_select(values[:, 0], t_start, t_end, step)]
+                yield (dataid, values[:, 0], values[:, 1:])
+        return
 
     with open(filepath) as datafile:
-        datareader = csv.reader(datafile,delimiter=';')
-        dataid = None
-        for row in datareader:
-            if len(row) > 2:
-                # Guard against incomplete rows
-                # (e.g. interrupted program)
-                dataid = row[0].replace('-','_')
-                t_id = 't_' + dataid
-                if not dataid:
-                    # Empty data ids appear in some datasets
-                    # This actually should not happen
-                    # This is a quick fix until we figure out 
-                    # the real cause of the problem
+        # Read line by line, so that only the grouped rows are held in memory
+        rows = _group_rows(datafile, streams)
+
+    for rowid in sorted(rows):
+        values = _parse_rows(rows[rowid], t_start, t_end, step)
+        rows[rowid] = None
+        yield (rowid.replace('-','_'), values[:, 0], values[:, 1:])
+
+def _group_rows(lines, streams = None, complete = False, widths = None):
+    """
+    Split log lines by data id.
+
+    Unless the lines are known to be complete, the last line is dropped
+    if it is shorter than the previous row of its data id
+    (e.g. interrupted program).
+
+    :param lines: Iterable of lines (e.g. a file object), with or without line endings.
+    :param list streams: Data ids to keep (default: all).
+    :param bool complete: The last line is complete (e.g. more lines follow).
+    :param dict widths: Number of ';' separated fields of the last row of each
+                        (raw) data id preceding the lines, if the lines do not
+                        start at the beginning of the log.
+    :return: A dictionary of lists of rows 'timestamp;value;value...', by (raw) data id.
+    """
+    selected = None
+    if streams is not None:
+        selected = set([s.replace('-','_') for s in streams])
+    rows = {}
+    skipped = set()
+    last = None
+    for line in lines:
+        # Data id of the last line, if it was kept
+        last = None
+        row = line.rstrip('\r\n').split(';', 1)
+        if len(row) > 1 and ';' in row[1]:
+            # At least a data id, a timestamp and one value
+            if not row[0]:
+                # Empty data ids appear in some datasets
+                # This actually should not happen
+                # This is a quick fix until we figure out
+                # the real cause of the problem
+                continue
+            if row[0] not in rows:
+                if row[0] in skipped:
+                    continue
+                if selected is not None and row[0].replace('-','_') not in selected:
+                    skipped.add(row[0])
                     continue
-                if dataid not in data[casu]:
-                    # New row id
-                    data[casu][dataid] = []
-                    data[casu][t_id] = []
-                try:
-                    ts = float(row[1]) # timestamp
-                    data[casu][t_id].append(ts)
-                    data[casu][dataid].append([float(x) for x in row[2:]])
-                except ValueError:
-                    #print('ValueError in row {0}: {1}'.format(datareader.line_num,row))
-                    # Accelerometers are currently not providing any data
-                    # We don't want to bother users with that
-                    pass
-
-        # Check final row (my be incomplete)
-        if dataid:
-            # Some data were present
-            if len(data[casu][dataid]) > 1:
-                # At least two rows were present
-                if not len(data[casu][dataid][-1]) == len(data[casu][dataid][-2]):
-                    # Remove last row if it's incomplete
-                    data[casu][dataid] = data[casu][dataid][:-1]
+                # New row id
+                rows[row[0]] = []
+            rows[row[0]].append(row[1])
+            last = row[0]
+
+    # Check final row (may be incomplete)
+    if not complete and last is not None:
+        previous = None
+        if len(rows[last]) > 1:
+            previous = rows[last][-2].count(';') + 1
+        elif widths:
+            previous = widths.get(last)
+        if previous is not None and rows[last][-1].count(';') + 1 < previous:
+            rows[last].pop()
+            if not rows[last]:
+                del rows[last]
+
+    return rows
+
+CACHE_SUFFIX = '.cache.npz'
+"""
+Suffix of the parsed log cache files, stored next to the csv logs.
+"""
+
+_CACHE_CHECK = 64
+
+_CACHE_VERSION = 2
+
+def load_cached_csv(filepath):
+    """
+    Load all data of a csv log, using a sidecar cache file.
+
+    The cache holds the parsed data, along with the size and modification
+    time of the log when it was parsed. If the log is unchanged, the data is
+    loaded from the cache. If rows have only been appended to the log,
+    just the new rows are parsed. Otherwise, the whole log is parsed again.
+
+    The final line of the log (which may still be incomplete, e.g. of a log
+    being written) is never cached, but parsed on every call, with the same
+    check as in :py:func:`iter_csv_streams`, so the results do not depend
+    on the cache.
+
+    :return: A dictionary of 2D arrays (with timestamps in the first column), by data id.
+    """
+    cachepath = filepath + CACHE_SUFFIX
+    stat = os.stat(filepath)
+
+    streams = {}
+    widths = {}
+    offset = 0
+    unchanged = False
+    if os.path.isfile(cachepath):
+        try:
+            cache = np.load(cachepath)
+            meta = cache['_meta']
+            # Caches of other versions are parsed again
+            if len(meta) == 4 and meta[0] == _CACHE_VERSION:
+                (size, mtime, cached_offset) = meta[1:]
+                check = cache['_check'].tostring()
+                unchanged = size == stat.st_size and mtime == stat.st_mtime
+                valid = unchanged
+                if not unchanged and stat.st_size >= size:
+                    # Make sure that the log has only grown
+                    with open(filepath, 'rb') as datafile:
+                        datafile.seek(int(cached_offset) - len(check))
+                        valid = datafile.read(len(check)) == check
+                if valid:
+                    streams = dict([(key[2:], cache[key]) for key in cache.files if key[:2] == 'd_'])
+                    widths = dict([(key[2:], int(cache[key])) for key in cache.files if key[:2] == 'w_'])
+                    offset = int(cached_offset)
+            cache.close()
+        except (IOError, ValueError, KeyError):
+            unchanged = False
+            print('WARNING: Ignoring invalid cache file {0}'.format(cachepath))
+
+    with open(filepath, 'rb') as datafile:
+        datafile.seek(offset)
+        text = datafile.read()
+    # Split off the final line
+    if text[-1:] == '\n':
+        split = text.rfind('\n', 0, len(text) - 1) + 1
+    else:
+        split = text.rfind('\n') + 1
+    final = text[split:]
+    text = text[:split]
+
+    if text:
+        offset += len(text)
+        rows = _group_rows(text.splitlines(), complete = True)
+        del text
+        for rowid in rows:
+            dataid = rowid.replace('-','_')
+            widths[rowid] = rows[rowid][-1].count(';') + 1
+            values = _parse_rows(rows[rowid])
+            rows[rowid] = None
+            if dataid in streams:
+                streams[dataid] = _stack([streams[dataid], values])
+            else:
+                streams[dataid] = values
+
+    if not unchanged:
+        with open(filepath, 'rb') as datafile:
+            datafile.seek(max(offset - _CACHE_CHECK, 0))
+            check = datafile.read(offset - max(offset - _CACHE_CHECK, 0))
+        arrays = dict([('d_' + dataid, streams[dataid]) for dataid in streams])
+        arrays.update([('w_' + rowid, np.array(widths[rowid])) for rowid in widths])
+        arrays['_meta'] = np.array([_CACHE_VERSION, stat.st_size, stat.st_mtime, offset],
+                                   dtype=float)
+        arrays['_check'] = np.frombuffer(check, dtype=np.uint8)
+        try:
+            # Write to a temporary file first, so that an interrupted
+            # run does not leave a broken cache behind
+            np.savez(cachepath + '.tmp.npz', **arrays)
+            os.rename(cachepath + '.tmp.npz', cachepath)
+        except (IOError, OSError):
+            print('WARNING: Could not write cache file {0}'.format(cachepath))
+
+    # Add the final line
+    rows = _group_rows([final], widths = widths)
+    for rowid in rows:
+        dataid = rowid.replace('-','_')
+        values = _parse_rows(rows[rowid])
+        if dataid in streams:
+            streams[dataid] = _stack([streams[dataid], values])
+        else:
+            streams[dataid] = values
+
+    return streams
+
+def iter_bin_streams(folderpath, streams = None, t_start = None, t_end = None, step = 1,
+                     cache = False):
+    """
+    Iterate over the data ids of a binary log folder
+    (see :py:class:`casulog.BinaryLog`).
+
+    Accepts the same selection parameters as :py:func:`iter_csv_streams`.
+    Binary logs need no parsing, so they are never cached.
+
+    Data ids logged with different row widths (one file per width) are
+    merged in time order, with shorter rows padded with NaN.
+
+    :return: A generator of (dataid, timestamps, values) tuples.
+    """
+    selected = None
+    if streams is not None:
+        selected = set([s.replace('-','_') for s in streams])
+    files = {}
+    for filename in sorted(os.listdir(folderpath)):
+        if filename[-3:] != '.f8':
+            continue
+        (dataid, width) = filename[:-3].rsplit('.', 1)
+        dataid = dataid.replace('-','_')
+        if selected is not None and dataid not in selected:
+            continue
+        width = int(width)
+        path = os.path.join(folderpath, filename)
+        # Drop an incomplete last record (e.g. interrupted program)
+        rows = os.path.getsize(path) // (8 * (width + 1))
+        files.setdefault(dataid, []).append((path, width, rows))
+
+    for dataid in sorted(files):
+        if len(files[dataid]) == 1:
+            (path, width, rows) = files[dataid][0]
+            values = _read_records(path, width, rows, t_start, t_end, step)
+        else:
+            # The same stream was logged with different row widths
+            # (e.g. VibrationPattern on and off echoes), merge them
+            values = _stack([_read_records(path, width, rows, t_start, t_end)
+                             for (path, width, rows) in files[dataid]])
+            values = values[np.argsort(values[:, 0], kind='mergesort')][::step]
+        yield (dataid, values[:, 0], values[:, 1:])
+
+def _read_records(path, width, rows, t_start = None, t_end = None, step = 1):
+    """
+    Read the first rows records of a binary log file of the given width
+    into a 2D array, with timestamps in the first column.
+    """
+    if rows == 0:
+        return np.zeros((0, width + 1))
+    elif t_start is not None or t_end is not None or step > 1:
+        # Read only the selected records
+        values = np.memmap(path, dtype='<f8', mode='r', shape=(rows, width + 1))
+        return np.array(values[_select(values[:, 0], t_start, t_end, step)])
+    else:
+        values = np.fromfile(path, dtype='<f8', count=rows * (width + 1))
+        return values.reshape(rows, width + 1)
+
+def load_from_csv(filepath, **select):
+    """
+    Load log data from a csv file.
+
+    :param select: Optional data selection (`streams`, `t_start`,
+                   `t_end`, `step`) and `cache` flag, see :py:func:`iter_csv_streams`.
+    """
+    casu = casu_name(filepath)
+    data = {casu: {}}
+    for (dataid, times, values) in iter_csv_streams(filepath, **select):
+        data[casu]['t_' + dataid] = times
+        data[casu][dataid] = values
 
     return data
 
-def process_folder(foldername):
+def load_from_bin(folderpath, **select):
     """
-    Recurse into subfolders and process all csv files.
+    Load log data from a binary log folder (see :py:class:`casulog.BinaryLog`).
+
+    :param select: Optional data selection, see :py:func:`load_from_csv`.
     """
-    data = {}
+    casu = casu_name(folderpath)
+    data = {casu: {}}
+    for (dataid, times, values) in iter_bin_streams(folderpath, **select):
+        data[casu]['t_' + dataid] = times
+        data[casu][dataid] = values
+
+    return data
+
+def is_bin_log(path):
+    """
+    Returns True if path is a binary log folder, False for csv logs.
+    """
+    return path.rstrip(os.sep)[-4:] == '.bin'
+
+def load_log(path, **select):
+    """
+    Load a csv or binary log.
+    """
+    if is_bin_log(path):
+        return load_from_bin(path, **select)
+    return load_from_csv(path, **select)
+
+def iter_log(path, **select):
+    """
+    Iterate over the data ids of a csv or binary log.
+    """
+    if is_bin_log(path):
+        return iter_bin_streams(path, **select)
+    return iter_csv_streams(path, **select)
+
+def find_logs(foldername):
+    """
+    Recurse into subfolders and find all csv files and binary log folders.
+    """
+    logs = []
 
     dirs = os.walk(foldername)
     for (dirpath, dirnames, filenames) in dirs:
-        for filename in filenames:
+        for filename in sorted(filenames):
             if filename[-4:] == '.csv':
-                new_data = load_from_csv(os.path.join(dirpath,filename))
-                if new_data.keys():
-                    casu = new_data.keys()[0]
-                    if casu in data.keys():
-                        print('WARNING: Found more than one logfile for {0}!'.format(casu))
-                        print('The output file will contain data from only one logfile!')
-                data = dict(data, **new_data)
+                logs.append(os.path.join(dirpath, filename))
+        for dirname in sorted(dirnames):
+            if dirname[-4:] == '.bin':
+                # Binary log folders are not recursed into
+                dirnames.remove(dirname)
+                logs.append(os.path.join(dirpath, dirname))
+
+    return logs
+
+def _load_log(path, **select):
+    """
+    Load one log (in a worker process).
+    """
+    try:
+        return load_log(path, **select)
+    except SystemExit as e:
+        # Exiting would kill the worker and leave the pool waiting
+        raise ValueError(str(e))
+
+def process_folder(foldername, jobs = 1, **select):
+    """
+    Recurse into subfolders and process all csv files and binary log folders.
+
+    :param int jobs: Number of worker processes used for parsing the logs.
+    :param select: Optional data selection, see :py:func:`load_from_csv`.
+    """
+    data = {}
+
+    logs = find_logs(foldername)
+    load = functools.partial(_load_log, **select)
+    pool = None
+    if jobs > 1 and len(logs) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(logs)))
+        results = pool.imap(load, logs)
+    else:
+        results = itertools.imap(load, logs)
+
+    try:
+        for new_data in results:
+            if new_data.keys():
+                casu = new_data.keys()[0]
+                if casu in data:
+                    print('WARNING: Found more than one logfile for {0}!'.format(casu))
+                    print('The output file will contain data from only one logfile!')
+            data.update(new_data)
+    except ValueError as e:
+        sys.exit(str(e))
+    finally:
+        if pool:
+            pool.terminate()
 
     return data
 
+class NpyWriter:
+    """
+    Streaming output into a folder 'outname_npy' of .npy files,
+    with one subfolder per CASU.
+
+    :param string outname: Output name.
+    """
+
+    def __init__(self, outname):
+        self.__outname = outname + '_npy'
+
+    def write(self, casu, dataid, times, values):
+        """
+        Write the data of one data id.
+        """
+        path = os.path.join(self.__outname, casu)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 't_' + dataid + '.npy'), times)
+        np.save(os.path.join(path, dataid + '.npy'), values)
+
+    def close(self):
+        pass
+
+class CasuMatWriter:
+    """
+    Streaming output into a folder 'outname_mat' with one .mat file per CASU.
+
+    :param string outname: Output name.
+    """
+
+    def __init__(self, outname):
+        self.__outname = outname + '_mat'
+        if not os.path.isdir(self.__outname):
+            os.makedirs(self.__outname)
+        self.__casu = None
+        self.__data = {}
+
+    def write(self, casu, dataid, times, values):
+        """
+        Write the data of one data id. The data of a CASU is
+        saved once the data of the next CASU arrives.
+        """
+        if casu != self.__casu:
+            self.close()
+            self.__casu = casu
+        self.__data['t_' + dataid] = times
+        self.__data[dataid] = values
+
+    def close(self):
+        """
+        Save the data of the last CASU.
+        """
+        if self.__casu:
+            sio.savemat(os.path.join(self.__outname, self.__casu),
+                        {self.__casu: self.__data}, oned_as='column')
+        self.__casu = None
+        self.__data = {}
+
+class Hdf5Writer:
+    """
+    Streaming output into a HDF5 file 'outname.h5', with one group per CASU.
+    Requires the h5py package.
+
+    :param string outname: Output name.
+    """
+
+    def __init__(self, outname):
+        try:
+            import h5py
+        except ImportError:
+            sys.exit('HDF5 output requires the h5py package!')
+        self.__file = h5py.File(outname + '.h5', 'w')
+
+    def write(self, casu, dataid, times, values):
+        """
+        Write the data of one data id.
+        """
+        group = self.__file.require_group(casu)
+        for (name, array) in [('t_' + dataid, times), (dataid, values)]:
+            if name in group:
+                del group[name]
+            group.create_dataset(name, data=array)
+
+    def close(self):
+        self.__file.close()
+
+WRITERS = {'npy': NpyWriter,
+           'casu-mat': CasuMatWriter,
+           'hdf5': Hdf5Writer}
+"""
+Streaming output writers, by output format name.
+"""
+
+def stream_logs(logs, writer, **select):
+    """
+    Pass the logs to writer one data id at a time, so that
+    at most one log file and one converted data id are held in memory.
+
+    :param select: Optional data selection, see :py:func:`load_from_csv`.
+    """
+    casus = set()
+    for path in logs:
+        casu = casu_name(path)
+        if casu in casus:
+            print('WARNING: Found more than one logfile for {0}!'.format(casu))
+            print('The output will contain data from only one logfile!')
+        casus.add(casu)
+        for (dataid, times, values) in iter_log(path, **select):
+            writer.write(casu, dataid, times, values)
+    writer.close()
+
 def main():
     """
     Main script entry point.
     """
-    # TODO: Use argparse and add reasonable options
-    # Document usage
     # Consider if the program should take an .assisi file as input?
+    parser = argparse.ArgumentParser(
+        description='Convert CASU logs into a Matlab .mat file, or another output format.')
+    parser.add_argument('path', help='CASU log (.csv file or .bin folder) to process, or a folder with CASU logs in its subfolders.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes used for parsing the logs of a folder (default: 1, mat format only)')
+    parser.add_argument('-f', '--format', default='mat', choices=['mat'] + sorted(WRITERS),
+                        help='output format: a single .mat file (default), a folder of .npy files, '
+                        'a folder of per-CASU .mat files or a HDF5 file. '
+                        'All formats except mat are written one data id at a time, '
+                        'so the whole dataset is never held in memory.')
+    parser.add_argument('--streams',
+                        help='comma-separated list of data ids to extract, e.g. temp,Peltier (default: all)')
+    parser.add_argument('--t-start', type=float, default=None,
+                        help='extract only data logged at or after this time')
+    parser.add_argument('--t-end', type=float, default=None,
+                        help='extract only data logged before this time')
+    parser.add_argument('--downsample', type=int, default=1,
+                        help='keep only every n-th row of each data id (default: 1)')
+    parser.add_argument('--cache', action='store_true', default=False,
+                        help='keep parsed data in a cache file next to each csv log, '
+                        'and parse only new rows on subsequent runs')
+    args = parser.parse_args()
+
+    select = {'t_start': args.t_start, 't_end': args.t_end,
+              'step': args.downsample, 'cache': args.cache}
+    if args.streams:
+        select['streams'] = args.streams.split(',')
 
     data = {}
-    
-    # The first argument is the name
-    # of the file/folder to process
-    outname = ''
-    if len(sys.argv) < 2:
-        sys.exit('Please provide a file or folder to process.')
-    elif sys.argv[1][-4:] == '.csv':
-        # We are assuming that we need to process a single .csv file
-        data = load_from_csv(sys.argv[1])
-        outname = sys.argv[1][:-4]
-    else:
+
+    # Output name (extension is added by the writer)
+    outname = args.path.rstrip(os.sep)[:-4]
+    logs = [args.path]
+    if args.path[-4:] != '.csv' and not is_bin_log(args.path):
         # We are assuming that the argument is a folder
         # to be processed. It is assumed that it contains
         # subfolders, each of which corresponds to one CASU.
         # Each subfolder is assumed to contain one or more
         # .csv files.
-        data = process_folder(sys.argv[1])
-        outname = sys.argv[1].rstrip(os.sep)
+        outname = args.path.rstrip(os.sep)
+        logs = None
 
-    sio.savemat(outname,data,oned_as='column')
+    if args.format != 'mat':
+        if logs is None:
+            logs = find_logs(args.path)
+        stream_logs(logs, WRITERS[args.format](outname), **select)
+    else:
+        if logs is None:
+            data = process_folder(args.path, args.jobs, **select)
+        else:
+            data = load_log(args.path, **select)
+        sio.savemat(outname,data,oned_as='column')
 
 
 if __name__ == '__main__':
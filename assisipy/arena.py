@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Bulk interface to all CASUs of an arena. """
+
+import collections
+import threading
+import time
+
+import numpy as np
+import yaml
+
+from msg import dev_msgs_pb2
+from msg import base_msgs_pb2
+
+import casu
+from comm import Hub
+
+Snapshot = collections.namedtuple('Snapshot', ['values', 'timestamps', 'seqs'])
+"""
+Latest readings of one sensor stream of all CASUs of an arena, as NumPy arrays:
+values (N×M, one row per CASU), timestamps (N receive times) and seqs
+(N update counters). Rows of CASUs that have not sent the stream yet are NaN,
+with seq 0. (The FFT streams have no fixed size, so they have no columns
+until some CASU has sent them.)
+"""
+
+# Number of values of the fixed-size sensor streams
+_WIDTHS = {'ir_range': casu.IR_FR - casu.IR_F + 1,
+           'ir_raw': casu.IR_FR - casu.IR_F + 1,
+           'temp': casu.TEMP_WAX - casu.TEMP_F + 1}
+
+class Arena:
+    """
+    All CASUs of an arena (as defined in an .arena file, see
+    :py:func:`sim.spawn_array_from_file`), driven through shared connections.
+
+    One :py:class:`comm.Hub` is created per data source (e.g. one for all
+    simulated CASUs), and every CASU gets a :py:class:`casu.Casu` object on it::
+
+        arena = Arena('demo.arena', layer_select = 'casu-layer')
+        arena.set_temp(dict([(name, 30) for name in arena.names()]))
+        arena.set_led([(1, 0, 0)] * len(arena.names()))
+
+    Values of the bulk setters are given either as a dictionary by CASU name,
+    or as a sequence (e.g. a NumPy array) ordered like :py:meth:`names`.
+
+    :param string arena_file_name: Name of the .arena file.
+    :param string layer_select: Name of the arena layer to use, or 'all'.
+    :param kwargs: :py:class:`casu.Casu` parameters (e.g. `log`, `timeout`),
+                   shared by all CASUs.
+    """
+
+    def __init__(self, arena_file_name, layer_select = 'all', **kwargs):
+        with open(arena_file_name) as arena_file:
+            arena = yaml.safe_load(arena_file)
+
+        selected_layers = arena.keys()
+        if layer_select != 'all':
+            if layer_select not in arena:
+                raise ValueError('{0} is not a layer in {1}!'.format(layer_select, arena_file_name))
+            selected_layers = [layer_select]
+
+        specs = {}
+        for layer in selected_layers:
+            if arena[layer]:
+                specs.update(arena[layer])
+        self.__names = sorted(specs)
+
+        self.__hubs = {}
+        self.__casus = {}
+        self.__casu_hubs = {}
+        for name in self.__names:
+            addresses = (specs[name].get('sub_addr', 'tcp://127.0.0.1:5555'),
+                         specs[name].get('pub_addr', 'tcp://127.0.0.1:5556'))
+            if addresses not in self.__hubs:
+                self.__hubs[addresses] = Hub(*addresses)
+            self.__casu_hubs[name] = self.__hubs[addresses]
+            self.__casus[name] = casu.Casu(name = name, hub = self.__hubs[addresses], **kwargs)
+        self.__casu_list = [self.__casus[name] for name in self.__names]
+
+    def names(self):
+        """
+        Returns the (sorted) list of CASU names.
+        """
+        return list(self.__names)
+
+    def casu(self, name):
+        """
+        Returns the :py:class:`casu.Casu` object of CASU name.
+        """
+        return self.__casus[name]
+
+    def casus(self):
+        """
+        Returns the list of :py:class:`casu.Casu` objects, ordered like :py:meth:`names`.
+        """
+        return list(self.__casu_list)
+
+    def snapshot(self, stream = 'temp'):
+        """
+        Returns the latest readings of a sensor stream of all CASUs as matrices,
+        e.g. an N×8 temperature matrix::
+
+            (temps, timestamps, seqs) = arena.snapshot('temp')
+
+        The per-CASU snapshots are collected in one pass before any conversion,
+        and every row holds the values of one received frame.
+
+        :param string stream: 'ir_range', 'ir_raw', 'temp', 'fft_freq' or 'fft_amp'
+                              (see :py:meth:`casu.Casu.get_reading`).
+        :return: A :py:class:`Snapshot`, with rows ordered like :py:meth:`names`.
+        """
+        readings = [c.get_reading(stream) for c in self.__casu_list]
+        seqs = np.array([r.seq for r in readings], dtype=np.int64)
+        timestamps = np.array([r.timestamp if r.seq else np.nan for r in readings])
+        widths = set([len(r.values) for r in readings])
+        width = max(widths | set([_WIDTHS.get(stream, 0)]))
+        if widths == set([width]):
+            values = np.array([r.values for r in readings], dtype=float).reshape(len(readings), width)
+        else:
+            # Some streams are missing (or of different sizes)
+            values = np.nan * np.ones((len(readings), width))
+            for (row, r) in zip(values, readings):
+                row[:len(r.values)] = r.values
+        return Snapshot(values, timestamps, seqs)
+
+    def set_temp(self, temps, slope = 0.025, force = False):
+        """
+        Set the temperature references of many CASUs (see :py:meth:`casu.Casu.set_temp`).
+
+        :param temps: Temperatures, by CASU name or in the order of :py:meth:`names`.
+        """
+        for (name, temp) in self.__items(temps):
+            self.__casus[name].set_temp(temp, slope = slope, force = force)
+
+    def temp_standby(self, force = False):
+        """
+        Turn the temperature actuators of all CASUs off.
+        """
+        for name in self.__names:
+            self.__casus[name].temp_standby(force = force)
+
+    def set_led(self, colors, force = False):
+        """
+        Set the diagnostic LED colors of many CASUs (see :py:meth:`casu.Casu.set_diagnostic_led_rgb`).
+
+        :param colors: (r, g, b) tuples, by CASU name or in the order of :py:meth:`names`
+                       (e.g. an N×3 array).
+        """
+        for (name, (r, g, b)) in self.__items(colors):
+            self.__casus[name].set_diagnostic_led_rgb(r, g, b, force = force)
+
+    def led_standby(self, force = False):
+        """
+        Turn the diagnostic LEDs of all CASUs off.
+        """
+        for name in self.__names:
+            self.__casus[name].diagnostic_led_standby(force = force)
+
+    def schedule_temp(self, times, temps, slope = 0.025):
+        """
+        Push a table of temperature references to the CASUs over time
+        (e.g. a temperature ramp).
+
+        All commands are serialized in advance, and sent by a background
+        thread, one batch per step. Scheduled commands are not logged,
+        and do not go through setpoint deduplication (but the setters
+        send their next setpoint even if it is unchanged, see
+        :py:meth:`casu.Casu.forget_setpoint`).
+
+        :param list times: Step times, in seconds from the start of the schedule.
+        :param temps: One row of temperatures per step, either as a dictionary
+                      by CASU name, or in the order of :py:meth:`names`
+                      (e.g. a T×N array).
+        :return: The running :py:class:`Schedule`.
+        """
+        msg = dev_msgs_pb2.Temperature()
+        def serialize(temp):
+            msg.temp = min(max(temp, casu.TEMP_MIN), casu.TEMP_MAX)
+            msg.slope = slope
+            return msg.SerializeToString()
+        return self.__schedule(times, temps, 'Peltier', serialize)
+
+    def schedule_led(self, times, colors):
+        """
+        Push a table of diagnostic LED colors to the CASUs over time,
+        see :py:meth:`schedule_temp`.
+
+        :param colors: One row of (r, g, b) tuples per step (e.g. a T×N×3 array).
+        """
+        msg = base_msgs_pb2.ColorStamped()
+        def serialize(color):
+            (msg.color.red, msg.color.green, msg.color.blue) = [min(max(c, 0), 1) for c in color]
+            return msg.SerializeToString()
+        return self.__schedule(times, colors, 'DiagnosticLed', serialize)
+
+    def stop(self):
+        """
+        Stop all CASUs and their connections.
+        """
+        for name in self.__names:
+            self.__casus[name].stop()
+        for hub in self.__hubs.values():
+            hub.stop()
+
+    def __items(self, values):
+        """
+        Returns (name, value) pairs of values given by name or by position.
+        """
+        if hasattr(values, 'items'):
+            return values.items()
+        if len(values) != len(self.__names):
+            raise ValueError('Expected {0} values, got {1}!'.format(len(self.__names), len(values)))
+        return zip(self.__names, values)
+
+    def __schedule(self, times, table, device, serialize):
+        """
+        Serialize a schedule table into batches of messages per hub.
+        """
+        if len(times) != len(table):
+            raise ValueError('Expected {0} schedule rows, got {1}!'.format(len(times), len(table)))
+        steps = []
+        for row in table:
+            batches = {}
+            for (name, value) in self.__items(row):
+                batches.setdefault(self.__casu_hubs[name], []).append(
+                    [name, device, 'On', serialize(value)])
+            steps.append(batches.items())
+        return Schedule(zip(times, steps), self.__casus)
+
+class Schedule:
+    """
+    Background thread sending pre-serialized message batches at given times.
+    Created by :py:meth:`Arena.schedule_temp` and :py:meth:`Arena.schedule_led`.
+
+    :param list steps: (time, [(hub, messages), ...]) pairs, with times in
+                       seconds from the start.
+    :param dict casus: :py:class:`casu.Casu` objects by name. The cached last
+                       setpoints of the addressed actuators are cleared after
+                       each step (see :py:meth:`casu.Casu.forget_setpoint`).
+    """
+
+    def __init__(self, steps, casus = None):
+        self.__steps = steps
+        self.__casus = casus or {}
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def wait(self, timeout = None):
+        """
+        Wait until all steps have been sent.
+
+        :return: True if the schedule is done, False if the timeout expired.
+        """
+        self.__thread.join(timeout)
+        return not self.__thread.is_alive()
+
+    def stop(self):
+        """
+        Cancel the remaining steps.
+        """
+        self.__stop.set()
+        self.__thread.join()
+
+    def __run(self):
+        start = time.time()
+        for (t, batches) in self.__steps:
+            if self.__stop.wait(max(start + t - time.time(), 0)):
+                break
+            for (hub, messages) in batches:
+                hub.send_many(messages)
+                for (name, device, cmd, data) in messages:
+                    if name in self.__casus:
+                        self.__casus[name].forget_setpoint(device)
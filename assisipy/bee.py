@@ -4,6 +4,8 @@
 """ Python interface to simulated bees. """
 
 import threading
+import collections
+import functools
 import time
 import sys
 
@@ -12,6 +14,11 @@ import zmq
 from msg import dev_msgs_pb2
 from msg import base_msgs_pb2
 
+from comm import Dispatcher, Updates, Connection, Callbacks, Reading, POLL_TIMEOUT
+from comm import configure_socket, drain
+import eventloop
+from replay import FrameRecorder
+
 
 LENGTH = 2
 """
@@ -106,6 +113,29 @@ class Bee:
     :param dict kwargs: accepts strings to override values for:
         `pub_addr` (defaults to localhost:5556)
         `sub_addr` (defautls to localhost:5555)
+        `timeout` maximum time (in seconds) to wait for the connection, after
+        which :py:class:`comm.ConnectionTimeout` is raised (defaults to None,
+        i.e. waiting forever)
+        `wait_all` if True, also wait until every sensor stream has been
+        received at least once (defaults to False)
+        `hub` a :py:class:`comm.Hub` (or :py:class:`replay.Replay`) data
+        source shared with other objects, used instead of own sockets and
+        receive thread
+        `record` name of a file to which all received data frames are
+        recorded (see :py:class:`replay.FrameRecorder`)
+        `socket_options` ZMQ socket options (see :py:func:`comm.configure_socket`)
+        `latest_only` if True, only the latest of several queued sensor frames of the
+        same stream is processed (see :py:func:`comm.drain`)
+        `streams` names of the data streams to process (see :py:meth:`get_seq`),
+        e.g. ['object', 'temp']; frames of other streams are dropped as soon
+        as they are received, without being parsed or recorded, and the
+        getters of those streams keep returning their initial values
+        (defaults to all streams)
+        `lazy` if True, frames are not parsed when they are received; only the
+        latest raw frame of each stream is kept, and parsed by the first getter
+        call that needs it (defaults to False)
+        `wait` if False, do not wait for the connection (used when the hub
+        is driven by the calling thread, see :py:class:`AsyncBee`)
 
     """
     
@@ -122,6 +152,8 @@ class Bee:
             #self.__pub_addr = 'tcp://127.0.0.1:5556'
             #self.__sub_addr = 'tcp://127.0.0.1:5555'
             self.__name = name
+        self.__socket_options = kwargs.get('socket_options', None)
+        self.__latest_only = kwargs.get('latest_only', False)
         
         self.__object_readings = dev_msgs_pb2.ObjectArray()
         self.__encoder_readings = dev_msgs_pb2.DiffDrive()
@@ -132,35 +164,74 @@ class Bee:
         self.__color_setpoint = base_msgs_pb2.ColorStamped()
         self.__airflow_reading = dev_msgs_pb2.AirflowReading()
 
-        # Connect the publisher socket
-        self.__connected = False
-        self.__context = zmq.Context(1)
-        self.__pub = self.__context.socket(zmq.PUB)
-        try:
-            self.__pub.connect(self.__pub_addr)
-        except zmq.error.ZMQError:
-            print('CONNECTION ERROR: Failed to connect to {0}'.format(self.__pub_addr))
-            sys.exit(1)
-
-        # Create the data update thread
-        self.__comm_thread = threading.Thread(target=self.__update_readings)
-        self.__comm_thread.daemon = True
         self.__lock =threading.Lock()
-        self.__comm_thread.start()
-
-        # Wait for the connection, check every second
-        while not self.__connected:
-            time.sleep(1)
-        print('{0} connected!'.format(self.__name))
-
-        # Wait one more second to get all the data
-        time.sleep(0.5)
+        self.__dispatcher = Dispatcher('Bee {0}'.format(self.__name))
+        self.__streams = {}
+        self.__callbacks = Callbacks()
+        self.__lazy = kwargs.get('lazy', False)
+        # Message buffer, decoder and (in lazy mode) latest unparsed frame by stream
+        self.__buffers = {}
+        self.__decoders = {}
+        self.__pending = {}
+        self.__register_handlers(kwargs.get('streams', None))
+        self.__connection = Connection(self.__name, set(['Object', 'Base', 'Light', 'Temp']) &
+                                       set([dev for (dev, cmd) in self.__streams]))
+
+        # Set up raw frame recording
+        self.__recorder = None
+        if kwargs.get('record', None):
+            self.__recorder = FrameRecorder(kwargs['record'])
+
+        self.__stop = False
+        hub = kwargs.get('hub', None)
+        self.__hub = hub
+        if hub:
+            # Commands go through the shared publisher,
+            # data comes in through the shared receive thread
+            self.__send = hub.send
+            hub.register(self.__name, self.__handle_frame)
+        else:
+            # Connect the publisher socket
+            self.__context = zmq.Context(1)
+            self.__pub = configure_socket(self.__context.socket(zmq.PUB),
+                                          self.__socket_options, 'pub')
+            try:
+                self.__pub.connect(self.__pub_addr)
+            except zmq.error.ZMQError:
+                print('CONNECTION ERROR: Failed to connect to {0}'.format(self.__pub_addr))
+                sys.exit(1)
+            self.__send = self.__pub.send_multipart
+
+            # Create the data update thread
+            self.__comm_thread = threading.Thread(target=self.__update_readings)
+            self.__comm_thread.daemon = True
+            self.__comm_thread.start()
+
+        if kwargs.get('wait', True):
+            # Wait for the connection, closing everything on timeout
+            self.__connection.wait(kwargs.get('timeout', None),
+                                   kwargs.get('wait_all', False), self.__close)
+
+    def __close(self):
+        """
+        Stop receiving data, and close the sockets and the recording file.
+        """
+        if self.__hub:
+            self.__hub.unregister(self.__name)
+        else:
+            self.__stop = True
+            self.__comm_thread.join()
+            self.__pub.close()
+            self.__context.term()
+        if self.__recorder:
+            self.__recorder.close()
 
     def __update_readings(self):
         """ 
         Get a message from Bee and update data. 
         """
-        self.__sub = self.__context.socket(zmq.SUB)
+        self.__sub = configure_socket(self.__context.socket(zmq.SUB),
+                                      self.__socket_options, 'sub')
         try:
             self.__sub.connect(self.__sub_addr)
         except zmq.error.ZMQError:
@@ -169,68 +240,142 @@ class Bee:
 
         self.__sub.setsockopt(zmq.SUBSCRIBE, self.__name)
                     
-        while True:
-            [name, dev, cmd, data] = self.__sub.recv_multipart()
-            self.__connected = True
-            
-            ### Range readings ###
-            if dev == 'Object':
-                if cmd == 'Ranges':
-                    # Protect write with a lock
-                    # to make sure all data is written before access
-                    with self.__lock:
-                        self.__object_readings.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, self.__name))
-
-            ### Base data ###
-            elif dev == 'Base':
-                if cmd == 'Enc':
-                    with self.__lock:
-                        self.__encoder_readings.ParseFromString(data)
-                elif cmd == 'GroundTruth':
-                    with self.__lock:
-                        self.__true_pose.ParseFromString(data)
-                elif cmd == 'VelRef':
-                    with self.__lock:
-                        self.__vel_setpoints.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for Bee {1}'.format(cmd, self.__name))
-            ### Light sensors ###
-            elif dev == 'Light':
-                if cmd == 'Readings':
-                    with self.__lock:
-                        self.__light_readings.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for Bee {1}'.format(cmd, self.__name))
+        while not self.__stop:
+            if self.__sub.poll(POLL_TIMEOUT):
+                drain(self.__sub, self.__handle_frame, self.__latest_only)
 
-            ### Temperature sensors ###
-            elif dev == 'Temp':
-                if cmd == 'Temperatures':
-                    with self.__lock:
-                        self.__temp_readings.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for Bee {1}'.format(cmd, self.__name))
-                    
-            ### Diagnostic color actuator ###
-            elif dev == 'Color':
-                if cmd == 'ColorVal':
-                    with self.__lock:
-                        self.__color_setpoint.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for Bee {1}'.format(cmd, self.__name))
+        self.__sub.close()
 
-            ### Air flow sensor ###
-            elif dev == 'Airflow':
-                if cmd == 'Reading':
-                    with self.__lock:
-                        self.__airflow_reading.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for airflow of Bee {1}'.format(cmd, self.__name))
+    def __handle_frame(self, name, dev, cmd, data):
+        """
+        Update local data from one received frame.
+        """
+        if not self.__dispatcher.ignores(dev, cmd):
+            if self.__recorder:
+                self.__recorder.record([name, dev, cmd, data])
+            self.__dispatcher.dispatch(dev, cmd, data)
+            stream = self.__streams.get((dev, cmd))
+            if stream:
+                self.__updates.notify(stream)
+                if self.__callbacks.registered(stream):
+                    self.__callbacks.fire(stream, self.__reading(stream))
+        self.__connection.received(dev)
+
+    def __reading(self, stream):
+        """
+        Returns a :py:class:`comm.Reading` of the latest update of stream.
+        """
+        with self.__lock:
+            self.__parse(stream)
+            values = tuple(self.__decoders[stream](self.__buffers[stream]))
+        return Reading(self.__updates.seq(stream), time.time(), values)
 
+    def __register_handlers(self, streams):
+        """
+        Fill the (dev, cmd) dispatch table of the receive loop.
+
+        :param list streams: Names of the selected streams, or None for all.
+        """
+        selected = set(streams or [])
+        names = []
+        def register(dev, cmd, msg, stream, decode):
+            names.append(stream)
+            if streams is None or stream in selected:
+                if self.__lazy:
+                    self.__dispatcher.register(dev, cmd, functools.partial(self.__pending.__setitem__, stream))
+                else:
+                    self.__dispatcher.register_parser(dev, cmd, msg, self.__lock)
+                self.__buffers[stream] = msg
+                self.__decoders[stream] = decode
+                self.__streams[(dev, cmd)] = stream
             else:
-                print('Unknown device {0} for Bee {1}'.format(dev, self.__name))
+                self.__dispatcher.ignore(dev, cmd)
+            selected.discard(stream)
+        # Callback values, as returned by the getters
+        wheels = lambda msg: (msg.vel_left, msg.vel_right)
+        color = lambda msg: (msg.color.red, msg.color.green, msg.color.blue)
+        register('Object', 'Ranges', self.__object_readings, 'object', lambda msg: msg.range)
+        register('Base', 'Enc', self.__encoder_readings, 'encoders', wheels)
+        register('Base', 'GroundTruth', self.__true_pose, 'ground_truth',
+                 lambda msg: (msg.pose.position.x, msg.pose.position.y, msg.pose.orientation.z))
+        register('Base', 'VelRef', self.__vel_setpoints, 'vel_ref', wheels)
+        register('Light', 'Readings', self.__light_readings, 'light', color)
+        register('Temp', 'Temperatures', self.__temp_readings, 'temp', lambda msg: msg.temp)
+        register('Color', 'ColorVal', self.__color_setpoint, 'color', color)
+        register('Airflow', 'Reading', self.__airflow_reading, 'airflow',
+                 lambda msg: (msg.intensity, msg.direction))
+        if selected:
+            raise ValueError('Unknown streams {0}!'.format(', '.join(sorted(selected))))
+        self.__updates = Updates(names)
+
+    def register_handler(self, dev, cmd, handler):
+        """
+        Register an additional handler for incoming frames.
+
+        :param string dev: Device name (second message frame).
+        :param string cmd: Command name (third message frame), or None to accept any command.
+        :param handler: Callable, invoked from the receive thread as handler(data),
+                        where data is the serialized message.
+        """
+        self.__dispatcher.register(dev, cmd, handler)
+
+    def name(self):
+        """
+        Returns the name of this Bee instance.
+        """
+        return self.__name
+
+    def __parse(self, stream):
+        """
+        Parse the pending frame of a stream (in lazy mode), with the lock held.
+        """
+        data = self.__pending.pop(stream, None)
+        if data is not None:
+            self.__buffers[stream].ParseFromString(data)
+
+    def streams(self):
+        """
+        Returns the names of the processed data streams (see the `streams` argument).
+        """
+        return sorted(self.__streams.values())
+
+    def get_seq(self, stream):
+        """
+        Returns the number of updates of a stream received so far.
 
+        :param string stream: 'object', 'encoders', 'ground_truth', 'vel_ref',
+                              'light', 'temp', 'color' or 'airflow'.
+        """
+        return self.__updates.seq(stream)
+
+    def wait_for_update(self, stream, timeout = None, seq = None):
+        """
+        Block until a new update of stream is received.
+
+        :param string stream: Stream name, see :py:meth:`get_seq`.
+        :param float timeout: Maximum time to wait (in seconds), or None to wait forever.
+        :param int seq: Wait for an update newer than seq (as returned by
+                        :py:meth:`get_seq`), instead of the next one.
+        :return: True if the stream was updated, False if the timeout expired.
+        """
+        return self.__updates.wait(stream, timeout, seq)
+
+    def on(self, stream, callback):
+        """
+        Register callback(reading) to be called from the receive thread on
+        every update of stream, with a :py:class:`comm.Reading` of the update
+        (as for :py:meth:`casu.Casu.on`). The values of the reading are those
+        returned by the getter of the stream (the ranges for 'object').
+        """
+        self.__updates.seq(stream) # Raise KeyError for unknown streams
+        self.__callbacks.add(stream, callback)
+        return callback
+
+    def off(self, stream, callback):
+        """
+        Remove a callback registered with :py:meth:`on`.
+        """
+        self.__callbacks.remove(stream, callback)
 
     def get_range(self, id):
         """ 
@@ -240,6 +385,7 @@ class Bee:
         """
         range = -1
         with self.__lock:
+            self.__parse('object')
             if self.__object_readings.range:
                 if id == ARRAY:
                     range = [val for val in self.__object_readings.range]
@@ -259,6 +405,7 @@ class Bee:
         """
         obj = None
         with self.__lock:
+            self.__parse('object')
             if self.__object_readings.type:
                 if id == ARRAY:
                     obj = [val for val in self.__object_readings.type]
@@ -274,6 +421,7 @@ class Bee:
         r = -1
         obj = None
         with self.__lock:
+            self.__parse('object')
             if self.__object_readings.range:
                 if id == ARRAY:
                     r = [val for val in self.__object_readings.range]
@@ -296,6 +444,7 @@ class Bee:
         """
         obj = None
         with self.__lock:
+            self.__parse('temp')
             if id == ARRAY:
                 obj = [val for val in self.__temp_readings.temp]
             else:
@@ -322,6 +471,7 @@ class Bee:
                  reports only blue intensity, r and g are always 0).
         """
         with self.__lock:
+            self.__parse('light')
             return (self.__light_readings.color.red,
                     self.__light_readings.color.green,
                     self.__light_readings.color.blue)
@@ -331,6 +481,7 @@ class Bee:
         :return: the airflow intensity sensed by airflow sensor id
         """
         with self.__lock:
+            self.__parse('airflow')
             return self.__airflow_reading.intensity
 
     def get_airflow_direction(self, id = 0):
@@ -338,6 +489,7 @@ class Bee:
         :return: the airflow angle sensed by airflow sensor id
         """
         with self.__lock:
+            self.__parse('airflow')
             return self.__airflow_reading.direction
 
     def set_color(self,r=0.93,g=0.79,b=0):
@@ -370,7 +522,7 @@ class Bee:
         color.color.green = g
         color.color.blue = b
 
-        self.__pub.send_multipart([self.__name,"Color","Set",color.SerializeToString()])
+        self.__send([self.__name,"Color","Set",color.SerializeToString()])
         
 
     def get_true_pose(self):
@@ -379,6 +531,7 @@ class Bee:
                  in the world.
         """
         with self.__lock:
+            self.__parse('ground_truth')
             return (self.__true_pose.pose.position.x,
                     self.__true_pose.pose.position.y,
                     self.__true_pose.pose.orientation.z)
@@ -400,7 +553,7 @@ class Bee:
         vel = dev_msgs_pb2.DiffDrive();
         vel.vel_left = vel_left
         vel.vel_right = vel_right
-        self.__pub.send_multipart([self.__name, "Base", "Vel", 
+        self.__send([self.__name, "Base", "Vel", 
                                    vel.SerializeToString()])
 
 
@@ -408,16 +561,133 @@ class Bee:
         """
         :return: (vel_left,vel_right) tuple of wheel velocity setpoints.
         """
-        return(self.__vel_setpoints.vel_left, 
-               self.__vel_setpoints.vel_right)
+        with self.__lock:
+            self.__parse('vel_ref')
+            return(self.__vel_setpoints.vel_left, 
+                   self.__vel_setpoints.vel_right)
 
     def get_color(self):
         """
         :return: (r,g,b) tuple of bee color setpoints.
         """
-        return(self.__color_setpoint.color.red,
-               self.__color_setpoint.color.green,
-               self.__color_setpoint.color.blue)
+        with self.__lock:
+            self.__parse('color')
+            return(self.__color_setpoint.color.red,
+                   self.__color_setpoint.color.green,
+                   self.__color_setpoint.color.blue)
+
+class AsyncBee(eventloop.AsyncDevice, Bee):
+    """
+    Bee interface for behaviours running on an :py:class:`eventloop.Loop`.
+
+    All AsyncBee objects of a loop share one pair of sockets and receive
+    their data in the loop thread (see :py:class:`casu.AsyncCasu`). The methods
+    that wait for data return futures, see :py:class:`eventloop.AsyncDevice`
+    (next_update resolves to a :py:class:`comm.Reading` of the stream).
+    Behaviours are generator coroutines::
+
+        def wander(bee):
+            yield bee.connect()
+            while True:
+                yield bee.next_update('object')
+                if bee.get_range(OBJECT_FRONT) < 2:
+                    bee.set_vel(-0.5, 0.5)
+                else:
+                    bee.set_vel(1, 1)
+
+    :param loop: The :py:class:`eventloop.Loop` running the behaviours.
+    :param string name: The name of the bee.
+    :param kwargs: `sub_addr`, `pub_addr` and other :py:class:`Bee` keyword
+                   arguments (except `hub`).
+    """
+
+    def __init__(self, loop, name = 'Bee', **kwargs):
+        eventloop.AsyncDevice.__init__(self, loop, ['object', 'encoders', 'light', 'temp'])
+        self.__hub = loop.hub(kwargs.get('sub_addr', 'tcp://127.0.0.1:5555'),
+                              kwargs.get('pub_addr', 'tcp://127.0.0.1:5556'),
+                              kwargs.get('socket_options', None),
+                              kwargs.get('latest_only', False))
+        kwargs['hub'] = self.__hub
+        kwargs['wait'] = False
+        Bee.__init__(self, name = name, **kwargs)
+
+    def stop(self):
+        """
+        Stop receiving data for this bee.
+        """
+        self.__hub.unregister(self.name())
+
+class Swarm:
+    """
+    A group of :py:class:`AsyncBee` objects driven from one event loop.
+
+    Usage::
+
+        loop = eventloop.Loop()
+        swarm = Swarm(loop, ['Bee-{0:03}'.format(i) for i in range(200)])
+        loop.run_until_complete(swarm.connect(timeout = 10))
+        loop.run_until_complete(swarm.run(wander))
+
+    :param loop: The :py:class:`eventloop.Loop` running the behaviours.
+    :param list names: Bee names.
+    :param kwargs: :py:class:`AsyncBee` keyword arguments, shared by all bees.
+    """
+
+    def __init__(self, loop, names, **kwargs):
+        self.__loop = loop
+        self.__bees = collections.OrderedDict()
+        for name in names:
+            self.__bees[name] = AsyncBee(loop, name, **kwargs)
+
+    def bees(self):
+        """
+        Returns the list of bees, in the order of the names.
+        """
+        return self.__bees.values()
+
+    def bee(self, name):
+        """
+        Returns the bee called name.
+        """
+        return self.__bees[name]
+
+    def connect(self, timeout = None, wait_all = False):
+        """
+        Returns a future completed once all bees are connected,
+        see :py:meth:`AsyncBee.connect`.
+        """
+        return eventloop.gather([bee.connect(timeout, wait_all) for bee in self.__bees.values()])
+
+    def run(self, behaviour, *args):
+        """
+        Start behaviour(bee, \*args), a generator coroutine, for every bee.
+
+        :return: A future of the list of behaviour results.
+        """
+        return eventloop.gather([self.__loop.spawn(behaviour(bee, *args))
+                                 for bee in self.__bees.values()])
+
+    def set_vel(self, velocities):
+        """
+        Set the wheel velocities of many bees at once.
+
+        :param velocities: A dictionary of (vel_left, vel_right) tuples by bee name,
+                           or a sequence of such tuples (or an N×2 array), in the
+                           order of :py:meth:`bees`.
+        """
+        if hasattr(velocities, 'items'):
+            for (name, (vel_left, vel_right)) in velocities.items():
+                self.__bees[name].set_vel(vel_left, vel_right)
+        else:
+            for (bee, (vel_left, vel_right)) in zip(self.__bees.values(), velocities):
+                bee.set_vel(vel_left, vel_right)
+
+    def stop(self):
+        """
+        Stop receiving data for all bees.
+        """
+        for bee in self.__bees.values():
+            bee.stop()
 
 
 if __name__ == '__main__':
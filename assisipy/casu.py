@@ -4,6 +4,9 @@
 """ Python interface to CASU functionality. """
 
 import threading
+import functools
+import collections
+import struct
 import time
 import sys
 
@@ -13,11 +16,18 @@ import yaml # For parsing configuration (.rtc) files
 
 # For logging
 from datetime import datetime
-import csv
+import casulog
+from replay import FrameRecorder
+import payload
 
 from msg import dev_msgs_pb2
 from msg import base_msgs_pb2
 
+from comm import Dispatcher, Updates, ThreadPool, Connection, Callbacks, submit_function
+from comm import EMPTY_READING, Reading, POLL_TIMEOUT
+from comm import configure_socket, drain
+import eventloop
+
 # Device ID definitions (for convenience)
 
 """ IR range sensors """
@@ -82,6 +92,15 @@ Special value to get all sensor values from an array of sensors
 (e.g. all proximity sensors)
 """
 
+STREAM_DEVICES = {'ir_range': 'IR', 'ir_raw': 'IR', 'temp': 'Temp',
+                  'fft_freq': 'Fft', 'fft_amp': 'Fft',
+                  'peltier': 'Peltier', 'airflow': 'Airflow',
+                  'diagnostic_led': 'DiagnosticLed', 'speaker': 'Speaker',
+                  'vibration_pattern': 'VibrationPattern'}
+"""
+Device (second message frame) carrying each data stream, see the `streams` parameter of :py:class:`Casu`.
+"""
+
 # Value limits
 VIBE_FREQ_MAX = 1500
 VIBE_PERIOD_MIN = 100
@@ -98,9 +117,31 @@ class Casu:
     :param string rtc_file_name: Name of the run-time configuration (RTC) file. If no file is provided, the default configuration is used; if `name` is provided, this parameter is ignored (and no RTC file is read).
     :param string name: Casu name (note: this value takes precedence over `rtc_file_name` if both provided: thus no RTC file is read)
     :param bool log: A variable indicating whether to log all incoming and outgoing data. If set to true, a logfile in the form 'YYYY-MM-DD-HH-MM-SS-name.csv' is created.
+    :param string log_format: 'csv' (default) for a text logfile, or 'binary' for a folder 'YYYY-MM-DD-HH-MM-SS-name.bin' of fixed-width binary records per stream (see :py:class:`casulog.BinaryLog`).
+    :param string record: Name of a file to which all received data frames are recorded, unparsed (see :py:class:`replay.FrameRecorder`). The recording can be fed back into a Casu using :py:class:`replay.Replay`.
+    :param int log_buffer: If greater than zero, log rows are queued in a ring buffer of this size and written by a background thread (see :py:class:`casulog.BufferedLog`), instead of being written from the receive thread.
+    :param float log_flush_interval: Maximum time (in seconds) a row stays in the log buffer.
+    :param string log_policy: What to do when the log buffer is full, 'drop' (the oldest rows) or 'block'.
+    :param hub: A :py:class:`comm.Hub` shared with other objects. If provided, the Casu does not create its own context, sockets and receive thread, but uses those of the hub (and the hub addresses take precedence over `pub_addr` and `sub_addr`).
+    :param float timeout: Maximum time (in seconds) to wait for the connection. If it expires, :py:class:`comm.ConnectionTimeout` is raised. By default, the constructor waits forever.
+    :param bool wait_all: If True, the constructor also waits until every sensor stream (IR, temperature, vibration) has been received at least once.
+    :param int msg_queue_size: Maximum number of queued inter-CASU messages. When the queue is full, the oldest message is dropped.
+    :param bool msg_latest: If True, only the latest message from each neighbor is kept in the queue.
+    :param dict socket_options: ZMQ socket options (e.g. receive/send high water marks, linger, TCP keepalive), see :py:func:`comm.configure_socket`. Options can also be given under the `socket_options` key of the RTC file (the constructor values take precedence). With a hub, only the inter-CASU message sockets are configured; the hub has its own options.
+    :param bool latest_only: If True, when several frames of the same sensor stream are queued, only the latest is processed (and logged; setpoint echoes are always processed), so a slow controller does not read stale data. With a hub, use the option of the hub instead.
+    :param list streams: Names of the data streams to process (see :py:data:`STREAM_DEVICES`), e.g. ['temp']. By default, all streams are processed. Frames of other streams are dropped as soon as they are received, without being parsed, logged or recorded, and the getters of those streams keep returning their initial values. Streams sent in the same frame (e.g. 'ir_range' and 'ir_raw') are always processed together.
+    :param bool lazy: If True, sensor frames are not decoded when they are received. The receive thread only keeps the latest raw frame of each sensor device, and the first getter call after an update decodes it (the result is kept until the next frame). Frames that are never read are never decoded. Frames of streams with callbacks (see :py:meth:`on`), and all frames when logging, are still decoded on receipt.
+    :param bool dedup_setpoints: If True (default), actuator setters do not send a setpoint that is equal to the last one sent to the same actuator (unless called with force = True).
+    :param bool wait: If False, the constructor does not wait for the connection (`timeout` and `wait_all` are ignored). Used when the hub is driven by the calling thread, see :py:class:`AsyncCasu`.
+    :param executor: Where callbacks registered with :py:meth:`on` run: None (default) for inline, in the receive thread; an int for a pool of that many threads owned by the Casu; an object with a submit(fn, \*args) method; or an event loop with a call_soon_threadsafe(fn, \*args) method.
     """
 
-    def __init__(self, rtc_file_name='casu.rtc', name = '', log = False, log_folder = '.'):
+    def __init__(self, rtc_file_name='casu.rtc', name = '', log = False, log_folder = '.', hub = None,
+                 timeout = None, wait_all = False,
+                 log_format = 'csv', log_buffer = 0, log_flush_interval = 1.0, log_policy = 'drop',
+                 record = None, msg_queue_size = 1000, msg_latest = False,
+                 socket_options = None, latest_only = False, streams = None, lazy = False,
+                 dedup_setpoints = True, wait = True, executor = None):
 
 
         if name:
@@ -112,6 +153,7 @@ class Casu:
             self.__msg_pub_addr = None
             self.__msg_sub = None
             self.__phys_logi_map = {}
+            self.__socket_options = socket_options
         else:
             # Parse the rtc file
             with open(rtc_file_name) as rtc_file:
@@ -123,6 +165,11 @@ class Casu:
             self.__neighbors = rtc['neighbors']
             self.__msg_sub = None
             self.__phys_logi_map = self.__read_comm_links(rtc_file_name)
+            self.__socket_options = rtc.get('socket_options') or {}
+            if socket_options:
+                self.__socket_options = dict(self.__socket_options, **socket_options)
+            latest_only = latest_only or rtc.get('latest_only', False)
+        self.__latest_only = latest_only
 
 
         self.__stop = False
@@ -130,10 +177,47 @@ class Casu:
         # TODO: Fill readings/setpoints with fake data
         #       to prevent program crashes.
 
-        # Sensor reading buffers
-        self.__ir_range_readings = dev_msgs_pb2.RangeArray()
-        self.__temp_readings = dev_msgs_pb2.TemperatureArray()
-        self.__vibe_readings = dev_msgs_pb2.VibrationReadingArray()
+        # Devices of the selected streams
+        if streams is None:
+            streams = STREAM_DEVICES.keys()
+        unknown = set(streams) - set(STREAM_DEVICES)
+        if unknown:
+            raise ValueError('Unknown streams {0}!'.format(', '.join(sorted(unknown))))
+        self.__streams = sorted(streams)
+        self.__devices = set([STREAM_DEVICES[stream] for stream in streams])
+
+        # Sensor message buffers and decoders by device, only used by the
+        # receive thread (in lazy mode, with the decode lock held),
+        # and only allocated for the selected streams
+        self.__sensors = {}
+        if 'IR' in self.__devices:
+            self.__sensors['IR'] = (dev_msgs_pb2.RangeArray(), self.__decode_ir_ranges,
+                                    ['ir_range', 'ir_raw'])
+        if 'Temp' in self.__devices:
+            self.__sensors['Temp'] = (dev_msgs_pb2.TemperatureArray(), self.__decode_temperatures,
+                                      ['temp'])
+        if 'Fft' in self.__devices:
+            self.__sensors['Fft'] = (dev_msgs_pb2.VibrationReadingArray(), self.__decode_fft_measurements,
+                                     ['fft_freq', 'fft_amp'])
+
+        # Latest sensor readings, as immutable snapshots by stream
+        self.__readings = dict([(stream, EMPTY_READING) for stream in
+                                ['ir_range', 'ir_raw', 'temp', 'fft_freq', 'fft_amp']])
+
+        # Lazy decoding: latest undecoded (seq, timestamp, data) frame by device
+        self.__lazy = lazy
+        self.__pending = {}
+        self.__decode_lock = threading.RLock()
+        self.__updates = Updates(self.__readings.keys() +
+                                 ['peltier', 'airflow', 'diagnostic_led', 'speaker',
+                                  'vibration_pattern', 'message'])
+
+        # Stream callbacks
+        self.__pool = None
+        if isinstance(executor, int):
+            self.__pool = ThreadPool(executor)
+            executor = self.__pool
+        self.__callbacks = Callbacks(submit_function(executor))
 
         # Actuator setpoint buffers
         self.__peltier_setpoint = dev_msgs_pb2.Temperature()
@@ -147,11 +231,32 @@ class Casu:
         self.__vibration_pattern = dev_msgs_pb2.VibrationPattern()
         self.__vibration_pattern_on = False
 
+        # Outgoing setpoint messages, reused by the setters
+        self.__temp_msg = dev_msgs_pb2.Temperature()
+        self.__vibration_msg = dev_msgs_pb2.VibrationSetpoint()
+        self.__light_msg = base_msgs_pb2.ColorStamped()
+        self.__airflow_msg = dev_msgs_pb2.Airflow()
+        self.__headers = {}
+        for device in ['Peltier', 'Speaker', 'DiagnosticLed', 'Airflow']:
+            for cmd in ['On', 'Off']:
+                self.__headers[(device, cmd)] = [self.__name, device, cmd]
+        self.__dedup_setpoints = dedup_setpoints
+        self.__last_setpoints = {}
+        self.__setpoint_lock = threading.Lock()
+
+        # Incoming frame handlers
+        self.__dispatcher = Dispatcher(self.__name)
+        self.__register_handlers()
+
         # Create the data update thread
-        self.__connected = False
-        self.__context = zmq.Context(1)
-        self.__comm_thread = threading.Thread(target=self.__update_readings)
-        self.__comm_thread.daemon = True
+        self.__connection = Connection(self.__name, set(['IR', 'Temp', 'Fft']) & self.__devices)
+        self.__hub = hub
+        if hub:
+            self.__context = hub.context()
+        else:
+            self.__context = zmq.Context(1)
+            self.__comm_thread = threading.Thread(target=self.__update_readings)
+            self.__comm_thread.daemon = True
         self.__lock =threading.Lock()
 
         # Set up logging
@@ -161,20 +266,38 @@ class Casu:
             now_str = now_str.replace(' ','-').replace(':','-')
             if log_folder[-1] != '/':
                 log_folder = log_folder + '/'
-            self.log_path = log_folder + now_str + '-' + self.__name + '.csv'
-            self.__logfile = open(self.log_path,'wb')
-            self.__logger = csv.writer(self.__logfile,delimiter=';')
+            if log_format == 'binary':
+                self.log_path = log_folder + now_str + '-' + self.__name + '.bin'
+                self.__logger = casulog.BinaryLog(self.log_path)
+            else:
+                self.log_path = log_folder + now_str + '-' + self.__name + '.csv'
+                self.__logger = casulog.CsvLog(self.log_path)
+            if log_buffer > 0:
+                self.__logger = casulog.BufferedLog(self.__logger, log_buffer,
+                                                    log_flush_interval, log_policy)
+
+        # Set up raw frame recording
+        self.__recorder = None
+        if record:
+            self.__recorder = FrameRecorder(record)
 
         # Create inter-casu communication sockets
-        self.__msg_queue = []
+        self.__msg_latest = msg_latest
+        if msg_latest:
+            # Messages by sender, in arrival order
+            self.__msg_queue = collections.OrderedDict()
+        else:
+            self.__msg_queue = collections.deque(maxlen = msg_queue_size)
         if self.__msg_pub_addr and self.__neighbors:
-            self.__msg_pub = self.__context.socket(zmq.PUB)
+            self.__msg_pub = configure_socket(self.__context.socket(zmq.PUB),
+                                              self.__socket_options, 'msg_pub')
             try:
                 self.__msg_pub.bind(self.__msg_pub_addr)
             except zmq.error.ZMQError:
                 print('CONNECTION ERROR: Failed to connect to {0}'.format(self.__msg_pub_addr))
                 sys.exit(1)
-            self.__msg_sub = self.__context.socket(zmq.SUB)
+            self.__msg_sub = configure_socket(self.__context.socket(zmq.SUB),
+                                              self.__socket_options, 'msg_sub')
             for direction in self.__neighbors:
                 try:
                     self.__msg_sub.connect(self.__neighbors[direction]['address'])
@@ -183,27 +306,39 @@ class Casu:
                     sys.exit(1)
             self.__msg_sub.setsockopt(zmq.SUBSCRIBE, self.__name)
 
-        # Connect the control publisher socket
-        self.__pub = self.__context.socket(zmq.PUB)
-        try:
-            self.__pub.connect(self.__pub_addr)
-        except zmq.error.ZMQError:
-            print('CONNECTION ERROR: Failed to connect to {0}'.format(self.__pub_addr))
-            sys.exit(1)
+        if hub:
+            # Commands go through the shared publisher,
+            # data comes in through the shared receive thread
+            self.__send = hub.send
+            hub.register(self.__name, self.__handle_frame)
+            if self.__msg_sub:
+                hub.add_socket(self.__msg_sub, self.__receive_message)
+        else:
+            # Connect the control publisher socket
+            self.__pub = configure_socket(self.__context.socket(zmq.PUB),
+                                          self.__socket_options, 'pub')
+            try:
+                self.__pub.connect(self.__pub_addr)
+            except zmq.error.ZMQError:
+                print('CONNECTION ERROR: Failed to connect to {0}'.format(self.__pub_addr))
+                sys.exit(1)
+            self.__send = self.__pub.send_multipart
 
-        # Connect to the device and start receiving data
-        self.__comm_thread.start()
-        # Wait for the connection
-        while not self.__connected:
-            time.sleep(1)
-        print('{0} connected!'.format(self.__name))
+            # Connect to the device and start receiving data
+            self.__comm_thread.start()
+
+        if wait:
+            # Wait for the connection, on timeout stop receiving
+            # and close the sockets before raising
+            self.__connection.wait(timeout, wait_all, self.__abort)
 
 
     def __update_readings(self):
         """
         Get data from Casu and update local data.
         """
-        self.__sub = self.__context.socket(zmq.SUB)
+        self.__sub = configure_socket(self.__context.socket(zmq.SUB),
+                                      self.__socket_options, 'sub')
         try:
             self.__sub.connect(self.__sub_addr)
         except zmq.error.ZMQError:
@@ -211,142 +346,301 @@ class Casu:
             sys.exit(1) # TODO: This might have some issues, as we're within a thread
         self.__sub.setsockopt(zmq.SUBSCRIBE, self.__name)
 
+        poller = zmq.Poller()
+        poller.register(self.__sub, zmq.POLLIN)
+        if self.__msg_sub:
+            poller.register(self.__msg_sub, zmq.POLLIN)
+
         while not self.__stop:
-            [name, dev, cmd, data] = self.__sub.recv_multipart()
-            self.__connected = True
-            ### Sensor measurements ###
-            if dev == 'IR':
-                if cmd == 'Ranges':
-                    # Protect write with a lock
-                    # to make sure all data is written before access
-                    with self.__lock:
-                        self.__ir_range_readings.ParseFromString(data)
-                    self.__write_to_log(['ir_range', time.time()] + [r for r in self.__ir_range_readings.range])
-                    self.__write_to_log(['ir_raw', time.time()] + [r for r in self.__ir_range_readings.raw_value])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, self.__name))
-            elif dev == 'Temp':
-                if cmd == 'Temperatures':
-                    with self.__lock:
-                        self.__temp_readings.ParseFromString(data)
-                    self.__write_to_log(['temp', time.time()] + [t for t in self.__temp_readings.temp])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, self.__name))
-            elif dev == 'Fft':
-                if cmd == 'Measurements':
-                    with self.__lock:
-                        self.__vibe_readings.ParseFromString(data)
-                    # Assuming there is only one FFT reading (one accelerometer)
-                    reading = self.__vibe_readings.reading[0]
-                    self.__write_to_log(['fft_freq', time.time()] + [f for f in reading.freq])
-                    self.__write_to_log(['fft_amp', time.time()] + [a for a in reading.amplitude])
-            elif dev == "Acc":
-                # TODO: remove this as soon as simulator is updated
-                pass
-
-            ### Actuator setpoints ###
-            elif dev == 'Peltier':
-                if cmd == 'Off':
-                    self.__peltier_on = False
-                    with self.__lock:
-                        self.__peltier_setpoint.ParseFromString(data)
-                    self.__write_to_log(['Peltier', time.time(), '0', self.__peltier_setpoint.temp])
-                elif cmd == 'On':
-                    self.__peltier_on = True
-                    with self.__lock:
-                        self.__peltier_setpoint.ParseFromString(data)
-                    self.__write_to_log(['Peltier', time.time(), '1',  self.__peltier_setpoint.temp])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, dev))
-            elif dev == 'Airflow':
-                if cmd == 'Off':
-                    self.__airflow_on = False
-                    with self.__lock:
-                        self.__airflow_setpoint.ParseFromString(data)
-                    self.__write_to_log(['Airflow', time.time(), '0', self.__airflow_setpoint.intensity])
-                elif cmd == 'On':
-                    self.__airflow_on = True
-                    with self.__lock:
-                        self.__airflow_setpoint.ParseFromString(data)
-                    self.__write_to_log(['Airflow', time.time(), '1', self.__airflow_setpoint.intensity])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, dev))
-            elif dev == 'DiagnosticLed':
-                if cmd == 'Off':
-                    self.__diagnostic_led_on = False
-                    with self.__lock:
-                        self.__diagnostic_led_setpoint.ParseFromString(data)
-                    self.__write_to_log(['DiagnosticLed', time.time(), '0'] +
-                                        [self.__diagnostic_led_setpoint.color.red,
-                                         self.__diagnostic_led_setpoint.color.green,
-                                         self.__diagnostic_led_setpoint.color.blue])
-                elif cmd == 'On':
-                    self.__diagnostic_led_on = True
-                    with self.__lock:
-                        self.__diagnostic_led_setpoint.ParseFromString(data)
-                    self.__write_to_log(['DiagnosticLed', time.time(), '1'] +
-                                        [self.__diagnostic_led_setpoint.color.red,
-                                         self.__diagnostic_led_setpoint.color.green,
-                                         self.__diagnostic_led_setpoint.color.blue])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, dev))
-            elif dev == 'Speaker':
-                if cmd == 'Off':
-                    self.__speaker_on = False
-                    with self.__lock:
-                        self.__speaker_setpoint.ParseFromString(data)
-                    self.__write_to_log(['Speaker', time.time(), '0',
-                                         self.__speaker_setpoint.freq,
-                                         self.__speaker_setpoint.amplitude])
-                elif cmd == 'On':
-                    self.__speaker_on = True
-                    with self.__lock:
-                        self.__speaker_setpoint.ParseFromString(data)
-                    self.__write_to_log(['Speaker', time.time(), '1',
-                                         self.__speaker_setpoint.freq,
-                                         self.__speaker_setpoint.amplitude])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, dev))
-            elif dev == 'VibrationPattern':
-                if cmd == 'On':
-                    self.__vibration_pattern_on = True
-                    with self.__lock:
-                        self.__vibration_pattern.ParseFromString(data)
-                    self.__write_to_log(['VibrationPattern', time.time(), '1']
-                                        + [t for t in self.__vibration_pattern.vibe_periods]
-                                        + [f for f in self.__vibration_pattern.vibe_freqs]
-                                        + [a for a in self.__vibration_pattern.vibe_amps])
-                elif cmd == 'Off':
-                    self.__vibration_pattern_on = False
-                    with self.__lock:
-                        self.__vibration_pattern.ParseFromString(data)
-                    self.__write_to_log(['VibrationPattern',time.time(),'0'])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, dev))
-            else:
-                print('Unknown device {0} for {1}'.format(dev, self.__name))
+            ready = dict(poller.poll(POLL_TIMEOUT))
+            if self.__sub in ready:
+                # Drain everything that is queued
+                drain(self.__sub, self.__handle_frame, self.__latest_only)
 
             ### Inter-CASU comms ###
-            if self.__msg_sub:
+            if self.__msg_sub in ready:
+                self.__receive_message(self.__msg_sub)
+
+        self.__sub.close()
+
+    def __handle_frame(self, name, dev, cmd, data):
+        """
+        Update local data from one received frame.
+        """
+        if not self.__dispatcher.ignores(dev, cmd):
+            if self.__recorder:
+                self.__recorder.record([name, dev, cmd, data])
+            self.__dispatcher.dispatch(dev, cmd, data)
+        self.__connection.received(dev)
+
+    def __register_handlers(self):
+        """
+        Fill the (dev, cmd) dispatch table of the receive loop.
+        """
+        def register(dev, cmd, handler):
+            # Frames of the other devices are dropped before dispatch
+            if dev in self.__devices:
+                self.__dispatcher.register(dev, cmd, handler)
+            else:
+                self.__dispatcher.ignore(dev)
+
+        ### Sensor measurements ###
+        register('IR', 'Ranges', functools.partial(self.__on_sensor, 'IR'))
+        register('Temp', 'Temperatures', functools.partial(self.__on_sensor, 'Temp'))
+        register('Fft', 'Measurements', functools.partial(self.__on_sensor, 'Fft'))
+        # TODO: remove this as soon as simulator is updated
+        self.__dispatcher.register('Acc', None, lambda data: None)
+
+        ### Actuator setpoints ###
+        for (cmd, on) in [('On', True), ('Off', False)]:
+            register('Peltier', cmd, functools.partial(self.__on_peltier, on))
+            register('Airflow', cmd, functools.partial(self.__on_airflow, on))
+            register('DiagnosticLed', cmd, functools.partial(self.__on_diagnostic_led, on))
+            register('Speaker', cmd, functools.partial(self.__on_speaker, on))
+            register('VibrationPattern', cmd, functools.partial(self.__on_vibration_pattern, on))
+
+    def register_handler(self, dev, cmd, handler):
+        """
+        Register an additional handler for incoming frames.
+
+        :param string dev: Device name (second message frame).
+        :param string cmd: Command name (third message frame), or None to accept any command.
+        :param handler: Callable, invoked from the receive thread as handler(data),
+                        where data is the serialized message.
+        """
+        self.__dispatcher.register(dev, cmd, handler)
+
+    def __publish(self, stream, now, values):
+        """
+        Replace the snapshot of a sensor stream. Rebinding a dictionary
+        entry is atomic, so readers see either the old or the new snapshot.
+        """
+        values = tuple(values)
+        reading = Reading(self.__updates.seq(stream) + 1, now, values)
+        self.__readings[stream] = reading
+        self.__updates.notify(stream)
+        if self.__callbacks.registered(stream):
+            self.__callbacks.fire(stream, reading)
+        if self.__log:
+            self.__write_to_log([stream, now] + list(values))
+
+    def __on_sensor(self, dev, data):
+        """
+        Handle a sensor frame of device dev.
+        """
+        (msg, decode, streams) = self.__sensors[dev]
+        now = time.time()
+        if not self.__lazy:
+            msg.ParseFromString(data)
+            for (stream, values) in decode(msg):
+                self.__publish(stream, now, values)
+        elif self.__log or [s for s in streams if self.__callbacks.registered(s)]:
+            # The values are needed right away
+            with self.__decode_lock:
+                self.__pending.pop(dev, None)
+                msg.ParseFromString(data)
+                for (stream, values) in decode(msg):
+                    self.__publish(stream, now, values)
+        else:
+            # Only keep the frame, the getters decode it when needed
+            self.__pending[dev] = (self.__updates.seq(streams[0]) + 1, now, data)
+            for stream in streams:
+                self.__updates.notify(stream)
+
+    def __reading(self, stream):
+        """
+        Returns the snapshot of a sensor stream, decoding its pending frame first.
+        """
+        if self.__pending:
+            dev = STREAM_DEVICES[stream]
+            if dev in self.__pending:
+                with self.__decode_lock:
+                    pending = self.__pending.pop(dev, None)
+                    if pending:
+                        (seq, now, data) = pending
+                        (msg, decode, streams) = self.__sensors[dev]
+                        msg.ParseFromString(data)
+                        for (s, values) in decode(msg):
+                            self.__readings[s] = Reading(seq, now, tuple(values))
+        return self.__readings[stream]
+
+    def __decode_ir_ranges(self, msg):
+        return [('ir_range', msg.range), ('ir_raw', msg.raw_value)]
+
+    def __decode_temperatures(self, msg):
+        return [('temp', msg.temp)]
+
+    def __decode_fft_measurements(self, msg):
+        if msg.reading:
+            # Assuming there is only one FFT reading (one accelerometer)
+            reading = msg.reading[0]
+            return [('fft_freq', reading.freq), ('fft_amp', reading.amplitude)]
+        return []
+
+    def __on_peltier(self, on, data):
+        self.__peltier_on = on
+        with self.__lock:
+            self.__peltier_setpoint.ParseFromString(data)
+        self.__updates.notify('peltier')
+        if self.__callbacks.registered('peltier'):
+            self.__callbacks.fire('peltier', (self.__peltier_setpoint.temp, on))
+        self.__write_to_log(['Peltier', time.time(), '1' if on else '0',
+                             self.__peltier_setpoint.temp])
+
+    def __on_airflow(self, on, data):
+        self.__airflow_on = on
+        with self.__lock:
+            self.__airflow_setpoint.ParseFromString(data)
+        self.__updates.notify('airflow')
+        if self.__callbacks.registered('airflow'):
+            self.__callbacks.fire('airflow', (self.__airflow_setpoint.intensity, on))
+        self.__write_to_log(['Airflow', time.time(), '1' if on else '0',
+                             self.__airflow_setpoint.intensity])
+
+    def __on_diagnostic_led(self, on, data):
+        self.__diagnostic_led_on = on
+        with self.__lock:
+            self.__diagnostic_led_setpoint.ParseFromString(data)
+        self.__updates.notify('diagnostic_led')
+        if self.__callbacks.registered('diagnostic_led'):
+            self.__callbacks.fire('diagnostic_led', (self.get_diagnostic_led_rgb(), on))
+        self.__write_to_log(['DiagnosticLed', time.time(), '1' if on else '0',
+                             self.__diagnostic_led_setpoint.color.red,
+                             self.__diagnostic_led_setpoint.color.green,
+                             self.__diagnostic_led_setpoint.color.blue])
+
+    def __on_speaker(self, on, data):
+        self.__speaker_on = on
+        with self.__lock:
+            self.__speaker_setpoint.ParseFromString(data)
+        self.__updates.notify('speaker')
+        if self.__callbacks.registered('speaker'):
+            self.__callbacks.fire('speaker', ((self.__speaker_setpoint.freq, self.__speaker_setpoint.amplitude), on))
+        self.__write_to_log(['Speaker', time.time(), '1' if on else '0',
+                             self.__speaker_setpoint.freq,
+                             self.__speaker_setpoint.amplitude])
+
+    def __on_vibration_pattern(self, on, data):
+        self.__vibration_pattern_on = on
+        with self.__lock:
+            self.__vibration_pattern.ParseFromString(data)
+        self.__updates.notify('vibration_pattern')
+        if self.__callbacks.registered('vibration_pattern'):
+            pattern = self.__vibration_pattern
+            self.__callbacks.fire('vibration_pattern', ((tuple(pattern.vibe_periods),
+                                                         tuple(pattern.vibe_freqs),
+                                                         tuple(pattern.vibe_amps)), on))
+        if on:
+            self.__write_to_log(['VibrationPattern', time.time(), '1']
+                                + list(self.__vibration_pattern.vibe_periods)
+                                + list(self.__vibration_pattern.vibe_freqs)
+                                + list(self.__vibration_pattern.vibe_amps))
+        else:
+            self.__write_to_log(['VibrationPattern', time.time(), '0'])
+
+    def on(self, stream, callback):
+        """
+        Register callback(value) to be called on every update of stream::
+
+            def proximity(reading):
+                if max(reading.values) > 1000:
+                    c.set_diagnostic_led_rgb(r = 1)
+            c.on('ir_raw', proximity)
+
+        Callbacks run on the executor given to the constructor
+        (by default in the receive thread, so they should return quickly).
+
+        :param string stream: Stream name, see :py:meth:`get_seq`.
+        :param callback: Called with a :py:class:`comm.Reading` for sensor streams,
+                         a (setpoint, on) tuple for setpoint echoes (with setpoint as
+                         returned by the corresponding getter), and a message
+                         dictionary (see :py:meth:`read_message`) for 'message'.
+        :return: The callback.
+        """
+        self.__updates.seq(stream) # Raise KeyError for unknown streams
+        self.__callbacks.add(stream, callback)
+        return callback
+
+    def off(self, stream, callback):
+        """
+        Remove a callback registered with :py:meth:`on`.
+        """
+        self.__callbacks.remove(stream, callback)
+
+    def __receive_message(self, socket):
+        """
+        Receive all pending inter-CASU messages.
+        """
+        while True:
+            try:
+                [name, msg, sender, data] = socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.ZMQError:
+                # No more messages
+                break
+            if msg == 'Data':
                 try:
-                    [name, msg, sender, data] = self.__msg_sub.recv_multipart(zmq.NOBLOCK)
-                    # Protect the message queue update with a lock
-                    with self.__lock:
-                        self.__msg_queue.append({'sender':sender, 'data':data})
-                except zmq.ZMQError:
-                    # Nobody is sending us a message. No biggie.
-                    pass
+                    data = payload.unpack(data)
+                except (ValueError, struct.error):
+                    print('Invalid data message from {0} for {1}'.format(sender, self.__name))
+                    continue
+            # Resolve the sender label (logical name for neighbour)
+            # once, from the records found in the RTC file
+            message = {'sender':sender, 'data':data,
+                       'label':self.__phys_logi_map.get(sender, None)}
+            # Protect the message queue update with a lock
+            with self.__lock:
+                if self.__msg_latest:
+                    # Move the sender to the end of the queue
+                    self.__msg_queue.pop(sender, None)
+                    self.__msg_queue[sender] = message
+                else:
+                    self.__msg_queue.append(message)
+            self.__updates.notify('message')
+            if self.__callbacks.registered('message'):
+                self.__callbacks.fire('message', dict(message))
 
-    def __cleanup(self):
+    def __abort(self):
+        """
+        Stop receiving data and close the sockets, after a connection timeout.
+        """
+        self.__stop = True
+        self.__cleanup(close = True)
+
+    def __cleanup(self, close = False):
         """
         Performs necessary cleanup operations, i.e. stops communication threads,
         closes connections and files.
+
+        :param bool close: Also close the sockets (and the ZMQ context, if it is
+                           not shared). Unsent messages are kept for the
+                           configured linger time (see the `socket_options`).
         """
-        # Wait for communicaton threads to finish
-        self.__comm_thread.join()
+        if self.__hub:
+            # The shared receive thread keeps running for other objects
+            self.__hub.unregister(self.__name)
+            if self.__msg_sub:
+                self.__hub.remove_socket(self.__msg_sub, close)
+        else:
+            # Wait for communicaton threads to finish
+            self.__comm_thread.join()
+
+        if close:
+            if self.__msg_sub:
+                self.__msg_pub.close()
+                if not self.__hub:
+                    self.__msg_sub.close()
+            if not self.__hub:
+                self.__pub.close()
+                self.__context.term()
+
+        if self.__pool:
+            self.__pool.shutdown()
 
         if self.__log:
-            self.__logfile.close()
+            self.__logger.close()
+
+        if self.__recorder:
+            self.__recorder.close()
 
     def name(self):
         """
@@ -354,6 +648,12 @@ class Casu:
         """
         return self.__name
 
+    def streams(self):
+        """
+        Returns the names of the processed data streams (see the `streams` parameter).
+        """
+        return list(self.__streams)
+
     def stop(self):
         """
         Stops the Casu interface and cleans up.
@@ -362,14 +662,51 @@ class Casu:
         """
 
         # Stop all devices
-        self.temp_standby()
-        self.speaker_standby()
-        self.diagnostic_led_standby()
+        self.temp_standby(force = True)
+        self.speaker_standby(force = True)
+        self.diagnostic_led_standby(force = True)
 
         self.__stop = True
         self.__cleanup()
         print('{0} disconnected!'.format(self.__name))
 
+    def get_reading(self, stream):
+        """
+        Returns the latest snapshot of a sensor stream.
+
+        :param string stream: 'ir_range', 'ir_raw', 'temp', 'fft_freq' or 'fft_amp'.
+        :return: A :py:class:`comm.Reading` (seq, timestamp, values) tuple.
+                 seq is 0 if the stream has not been received yet.
+        """
+        return self.__reading(stream)
+
+    def get_seq(self, stream):
+        """
+        Returns the number of updates of a stream received so far.
+
+        :param string stream: One of the sensor streams of :py:meth:`get_reading`,
+                              'peltier', 'airflow', 'diagnostic_led', 'speaker',
+                              'vibration_pattern' (setpoint echoes) or 'message'.
+        """
+        return self.__updates.seq(stream)
+
+    def wait_for_update(self, stream, timeout = None, seq = None):
+        """
+        Block until a new update of stream is received, e.g.::
+
+            while True:
+                if c.wait_for_update('temp', timeout = 1):
+                    react(c.get_temp(ARRAY))
+
+        :param string stream: Stream name, see :py:meth:`get_seq`.
+        :param float timeout: Maximum time to wait (in seconds), or None to wait forever.
+        :param int seq: Wait for an update newer than seq (as returned by
+                        :py:meth:`get_seq` or :py:meth:`get_reading`),
+                        instead of the next one.
+        :return: True if the stream was updated, False if the timeout expired.
+        """
+        return self.__updates.wait(stream, timeout, seq)
+
     def get_range(self, id):
         """
         Returns the range reading (in cm) corresponding to sensor id.
@@ -379,47 +716,86 @@ class Casu:
            This API call might become deprecated in favor of get_raw_value,
            to better reflect actual sensor capabilities.
         """
-        with self.__lock:
-            if self.__ir_range_readings.range:
-                return self.__ir_range_readings.range[id-IR_F]
-            else:
-                return -1
+        values = self.__reading('ir_range').values
+        if values:
+            return values[id-IR_F]
+        else:
+            return -1
 
     def get_ir_raw_value(self, id):
         """
         Returns the raw value from the IR proximity sensor corresponding to sensor id.
+        If id is ARRAY, returns a tuple of all raw values.
 
         """
-        with self.__lock:
-            if self.__ir_range_readings.raw_value:
-                if id == ARRAY:
-                    return [raw for raw in self.__ir_range_readings.raw_value]
-                else:
-                    return self.__ir_range_readings.raw_value[id-IR_F]
+        values = self.__reading('ir_raw').values
+        if values:
+            if id == ARRAY:
+                return values
             else:
-                return -1
+                return values[id-IR_F]
+        else:
+            return -1
 
     def get_temp(self, id):
         """
         Returns the temperature reading of sensor id.
+        If id is ARRAY, returns a tuple of all temperatures.
 
          """
-        with self.__lock:
-            if self.__temp_readings.temp:
-                if id == ARRAY:
-                    return [t for t in self.__temp_readings.temp]
-                else:
-                    return self.__temp_readings.temp[id - TEMP_F]
+        values = self.__reading('temp').values
+        if values:
+            if id == ARRAY:
+                return values
             else:
-                return -1
+                return values[id - TEMP_F]
+        else:
+            return -1
+
+    def __send_setpoint(self, device, cmd, msg, fields, force, part = None):
+        """
+        Set fields (a list of (name, value) pairs) of the reused message msg
+        (or of its submessage part), and send msg to device. The send is skipped
+        if the setpoint equals the last one sent to the device.
+
+        :return: True if the setpoint was sent.
+        """
+        setpoint = (cmd,) + tuple([value for (name, value) in fields])
+        with self.__setpoint_lock:
+            if (self.__dedup_setpoints and not force
+                and self.__last_setpoints.get(device) == setpoint):
+                return False
+            # Reset fields left over from other setpoints
+            msg.Clear()
+            target = msg
+            if part:
+                target = getattr(msg, part)
+            for (name, value) in fields:
+                setattr(target, name, value)
+            self.__send(self.__headers[(device, cmd)] + [msg.SerializeToString()])
+            self.__last_setpoints[device] = setpoint
+        return True
+
+    def forget_setpoint(self, device):
+        """
+        Forget the last setpoint sent to an actuator, so that the next setter
+        call sends its setpoint even if it is unchanged. Needed when commands
+        are sent to the actuator without the setters (e.g. by
+        :py:meth:`arena.Arena.schedule_temp`).
+
+        :param string device: 'Peltier', 'Speaker', 'DiagnosticLed' or 'Airflow'.
+        """
+        with self.__setpoint_lock:
+            self.__last_setpoints.pop(device, None)
 
-    def set_temp(self, temp, id = PELTIER_ACT, slope = 0.025):
+    def set_temp(self, temp, id = PELTIER_ACT, slope = 0.025, force = False):
         """
         Sets the temperature reference of actuator id to temp.
 
         Slope limits the velocity of the temperature reference rise.
         0.025 deg/s is an experimentally determined appropriate value.
 
+        :param bool force: Send the setpoint even if it equals the last one sent.
         """
         if temp < TEMP_MIN:
             temp = TEMP_MIN
@@ -427,25 +803,20 @@ class Casu:
         elif temp > TEMP_MAX:
             temp = TEMP_MAX
             print('Temperature reference limited to {0}!'.format(temp))
-        temp_msg = dev_msgs_pb2.Temperature()
-        temp_msg.temp = temp
-        temp_msg.slope = slope
         device = "Peltier"
-        self.__pub.send_multipart([self.__name, device, "On",
-                                   temp_msg.SerializeToString()])
-        self.__write_to_log([device + "_temp", time.time(), temp])
+        if self.__send_setpoint(device, "On", self.__temp_msg,
+                                [('temp', temp), ('slope', slope)], force):
+            self.__write_to_log([device + "_temp", time.time(), temp])
 
-    def temp_standby(self, id = PELTIER_ACT):
+    def temp_standby(self, id = PELTIER_ACT, force = False):
         """
         Turn the temperature actuator off.
 
         """
-        temp_msg = dev_msgs_pb2.Temperature()
-        temp_msg.temp = 0
         device = "Peltier"
-        self.__pub.send_multipart([self.__name, device, "Off",
-                                   temp_msg.SerializeToString()])
-        self.__write_to_log([device + "_temp", time.time(), 0])
+        if self.__send_setpoint(device, "Off", self.__temp_msg,
+                                [('temp', 0)], force):
+            self.__write_to_log([device + "_temp", time.time(), 0])
 
     def get_peltier_setpoint(self, id = PELTIER_ACT):
         """
@@ -456,13 +827,14 @@ class Casu:
         """
         return(self.__peltier_setpoint.temp,self.__peltier_on)
 
-    def set_speaker_vibration(self, freq, intens,  id = VIBE_ACT):
+    def set_speaker_vibration(self, freq, intens,  id = VIBE_ACT, force = False):
         """
         Sets intensity value (0-50) and frequency to the speaker.
 
         :param
             float freq: Speaker frequency value, between 0 and 1500
             float intens: Speaker intensity value , between 0 and 50 %.
+            bool force: Send the setpoint even if it equals the last one sent.
         """
         if intens < 0:
             intens = 0
@@ -478,12 +850,9 @@ class Casu:
             freq = VIBE_FREQ_MAX
             print('Frequency limited to {0}!'.format(freq))
 
-        vibration = dev_msgs_pb2.VibrationSetpoint()
-        vibration.freq = freq
-        vibration.amplitude = intens
-        self.__pub.send_multipart([self.__name, "Speaker", "On",
-                                   vibration.SerializeToString()])
-        self.__write_to_log(["speaker_freq_pwm", time.time(), freq, intens])
+        if self.__send_setpoint("Speaker", "On", self.__vibration_msg,
+                                [('freq', freq), ('amplitude', intens)], force):
+            self.__write_to_log(["speaker_freq_pwm", time.time(), freq, intens])
 
     def get_speaker_freq(self, id=VIBE_ACT):
         """
@@ -554,8 +923,11 @@ class Casu:
             pattern.vibe_periods.extend(vibe_periods)
             pattern.vibe_freqs.extend(vibe_freqs)
             pattern.vibe_amps.extend(vibe_amps)
-            self.__pub.send_multipart([self.__name, "VibrationPattern", "On",
+            self.__send([self.__name, "VibrationPattern", "On",
                                    pattern.SerializeToString()])
+            # The pattern replaces the speaker setpoint
+            with self.__setpoint_lock:
+                self.__last_setpoints.pop("Speaker", None)
             self.__write_to_log(["Setting Vibration Pattern", time.time()]
                                 + vibe_periods + vibe_freqs + vibe_amps)
 
@@ -572,18 +944,15 @@ class Casu:
                 self.__vibration_pattern.vibe_freqs,
                 self.__vibration_pattern.vibe_amps)
 
-    def speaker_standby(self, id  = VIBE_ACT):
+    def speaker_standby(self, id  = VIBE_ACT, force = False):
         """
         Turn the vibration actuators (bot motor and speaker) off.
         """
 
-        vibration = dev_msgs_pb2.VibrationSetpoint()
-        vibration.freq = 0
-        vibration.amplitude = 0
-        self.__pub.send_multipart([self.__name, "Speaker", "Off",
-                                   vibration.SerializeToString()])
-        self.__write_to_log(["vibe_ref", time.time(), 0])
-        self.__write_to_log(["speaker_freq_intens", time.time(), 0, 0])
+        if self.__send_setpoint("Speaker", "Off", self.__vibration_msg,
+                                [('freq', 0), ('amplitude', 0)], force):
+            self.__write_to_log(["vibe_ref", time.time(), 0])
+            self.__write_to_log(["speaker_freq_intens", time.time(), 0, 0])
 
     def get_vibration_readings(self, id=FFT):
         """
@@ -591,34 +960,31 @@ class Casu:
 
         Returns
         -------
-        tuple of lists: frequencies and amplitudes of 4 dominant FFT spectrum components
+        tuple of tuples: frequencies and amplitudes of 4 dominant FFT spectrum components
             (freqs, amps)
         """
 
-        return (self.__vibe_readings.reading[0].freq,
-                self.__vibe_readings.reading[0].amplitude)
+        return (self.__reading('fft_freq').values,
+                self.__reading('fft_amp').values)
 
-    def set_diagnostic_led_rgb(self, r = 0, g = 0, b = 0, id = DLED_TOP):
+    def set_diagnostic_led_rgb(self, r = 0, g = 0, b = 0, id = DLED_TOP, force = False):
         """
         Set the diagnostic LED light color. Automatically turns the actuator on.
 
         :param float r: Red component intensity, between 0 and 1.
         :param float g: Green component intensity, between 0 and 1.
         :param float b: Blue component intensity, between 0 and 1.
+        :param bool force: Send the setpoint even if it equals the last one sent.
         """
 
         # Limit values to [0,1] range
-        r = sorted([0, r, 1])[1]
-        g = sorted([0, g, 1])[1]
-        b = sorted([0, b, 1])[1]
-
-        light = base_msgs_pb2.ColorStamped()
-        light.color.red = r
-        light.color.green = g
-        light.color.blue = b
-        self.__pub.send_multipart([self.__name, "DiagnosticLed", "On",
-                                   light.SerializeToString()])
-        self.__write_to_log(["dled_ref", time.time(), r, g, b])
+        r = min(max(r, 0), 1)
+        g = min(max(g, 0), 1)
+        b = min(max(b, 0), 1)
+
+        if self.__send_setpoint("DiagnosticLed", "On", self.__light_msg,
+                                [('red', r), ('green', g), ('blue', b)], force, 'color'):
+            self.__write_to_log(["dled_ref", time.time(), r, g, b])
 
     def get_diagnostic_led_rgb(self, id = DLED_TOP):
         """
@@ -638,29 +1004,24 @@ class Casu:
         """
         return self.__diagnostic_led_on
 
-    def diagnostic_led_standby(self, id = DLED_TOP):
+    def diagnostic_led_standby(self, id = DLED_TOP, force = False):
         """
         Turn the diagnostic LED off.
         """
-        light = base_msgs_pb2.ColorStamped();
-        light.color.red = 0
-        light.color.green = 0
-        light.color.blue = 0
-        self.__pub.send_multipart([self.__name, "DiagnosticLed", "Off",
-                                  light.SerializeToString()])
-        self.__write_to_log(["dled_ref", time.time(), 0, 0, 0])
+        if self.__send_setpoint("DiagnosticLed", "Off", self.__light_msg,
+                                [('red', 0), ('green', 0), ('blue', 0)], force, 'color'):
+            self.__write_to_log(["dled_ref", time.time(), 0, 0, 0])
 
-    def set_airflow_intensity(self, intensity, id = AIRFLOW_ACT):
+    def set_airflow_intensity(self, intensity, id = AIRFLOW_ACT, force = False):
         """
         Set the airflow intensity.
 
         :param float intensity: Airflow intensity (in precentage of maximum actuator value).
+        :param bool force: Send the setpoint even if it equals the last one sent.
         """
-        int_msg = dev_msgs_pb2.Airflow()
-        int_msg.intensity = intensity
-        self.__pub.send_multipart([self.__name, "Airflow", "On",
-                                   int_msg.SerializeToString()])
-        self.__write_to_log(["airflow_ref", time.time(), intensity])
+        if self.__send_setpoint("Airflow", "On", self.__airflow_msg,
+                                [('intensity', intensity)], force):
+            self.__write_to_log(["airflow_ref", time.time(), intensity])
 
     def get_airflow_intensity(self, id = AIRFLOW_ACT):
         """
@@ -674,22 +1035,20 @@ class Casu:
         """
         return self.__airflow_on
 
-    def airflow_standby(self, id  = AIRFLOW_ACT):
+    def airflow_standby(self, id  = AIRFLOW_ACT, force = False):
         """
         Puts the airflow actuator on standby.
         """
-        int_msg = dev_msgs_pb2.Airflow()
-        int_msg.intensity = 0
-        self.__pub.send_multipart([self.__name, "Airflow", "Off",
-                                   int_msg.SerializeToString()])
-        self.__write_to_log(["airflow_ref", time.time(), 0])
+        if self.__send_setpoint("Airflow", "Off", self.__airflow_msg,
+                                [('intensity', 0)], force):
+            self.__write_to_log(["airflow_ref", time.time(), 0])
 
     def ir_standby(self, command = "Standby"):
 
 	validCommands = ["Standby", "Activate"]
 
 	if (command in validCommands):
-		self.__pub.send_multipart([self.__name, "IR", command, "0"])
+		self.__send([self.__name, "IR", command, "0"])
 	else:
 		print "Invalid ir-standby command. Valid commands: Standby, Activate"
 
@@ -709,30 +1068,106 @@ class Casu:
 
         return success
 
+    def send_data(self, direction, data):
+        """
+        Send numeric data to one of the neighbors, in a compact binary
+        encoding (see :py:mod:`payload`). The receiving Casu decodes it, and
+        :py:meth:`read_message` returns it as a tuple of floats, or a dictionary
+        of floats by key.
+
+        :param data: A sequence of numbers, or a dictionary of numbers by string key.
+        """
+        return self.__send_to([direction], 'Data', payload.pack(data)) == 1
+
+    def broadcast(self, msg, directions = None):
+        """
+        Send a simple string message to several neighbors.
+
+        :param string msg: The message.
+        :param list directions: Neighbor directions (default: all neighbors).
+        :return: The number of sent messages (unknown directions are skipped).
+        """
+        return self.__send_to(directions, 'Message', msg)
+
+    def broadcast_data(self, data, directions = None):
+        """
+        Send numeric data (see :py:meth:`send_data`) to several neighbors.
+        The data is encoded only once.
+
+        :return: The number of sent messages.
+        """
+        return self.__send_to(directions, 'Data', payload.pack(data))
+
+    def __send_to(self, directions, cmd, data):
+        """
+        Send a message to the neighbors in directions (default: all).
+        """
+        if not self.__neighbors:
+            return 0
+        if directions is None:
+            directions = self.__neighbors.keys()
+        count = 0
+        for direction in directions:
+            if direction in self.__neighbors:
+                self.__msg_pub.send_multipart([self.__neighbors[direction]['name'], cmd,
+                                               self.__name, data])
+                count += 1
+
+        return count
+
     def read_message(self):
         """
-        Retrieve the latest message from the buffer.
+        Retrieve the oldest message from the buffer (messages are read in the
+        order they were received).
 
-        Returns a dictionary with sender(string), and data (string) fields.
+        Returns a dictionary with sender(string), data (string) and label
+        (the neighbor direction of the sender, from the RTC file) fields.
         """
         msg = []
-        if self.__msg_queue:
-            with self.__lock:
-                msg = self.__msg_queue.pop()
-
-                # attempt to find the label (logical name for neighbour) from
-                # the records found in the RTC file (now part of the Casu
-                # instance)
-                msg['label'] = self.__phys_logi_map.get(msg['sender'], None)
+        with self.__lock:
+            if self.__msg_queue:
+                if self.__msg_latest:
+                    msg = self.__msg_queue.popitem(last = False)[1]
+                else:
+                    msg = self.__msg_queue.popleft()
 
         return msg
 
+    def read_messages(self, max_n = None):
+        """
+        Retrieve all buffered messages (or the oldest max_n of them) at once.
+
+        :return: A list of message dictionaries (see :py:meth:`read_message`),
+                 oldest first.
+        """
+        with self.__lock:
+            count = len(self.__msg_queue)
+            if max_n is not None:
+                count = min(count, max_n)
+            if self.__msg_latest:
+                msgs = [self.__msg_queue.popitem(last = False)[1] for i in range(count)]
+            elif count == len(self.__msg_queue):
+                msgs = list(self.__msg_queue)
+                self.__msg_queue.clear()
+            else:
+                msgs = [self.__msg_queue.popleft() for i in range(count)]
+
+        return msgs
+
     def __write_to_log(self, data):
         """
         Write one line of data to the logfile.
         """
         if self.__log:
-            self.__logger.writerow(data)
+            self.__logger.write(data)
+
+    def log_dropped(self):
+        """
+        Returns the number of log rows dropped because the log buffer was full.
+        """
+        if self.__log and isinstance(self.__logger, casulog.BufferedLog):
+            return self.__logger.dropped()
+        return 0
 
     def __read_comm_links(self, rtc):
         '''
@@ -755,6 +1190,57 @@ class Casu:
 
 
 
+class AsyncCasu(eventloop.AsyncDevice, Casu):
+    """
+    Casu interface for controllers running on an :py:class:`eventloop.Loop`.
+
+    All AsyncCasu objects of a loop (with the same data source addresses)
+    share one pair of sockets, and their data is received in the loop thread,
+    so one process can run hundreds of CASU controllers without any threads::
+
+        def controller(c):
+            yield c.connect()
+            while True:
+                reading = yield c.next_update('ir_raw')
+                if max(reading.values) > 1000:
+                    c.set_temp(36)
+
+        loop = eventloop.Loop()
+        casus = [AsyncCasu(loop, name = 'casu-{0:03}'.format(i)) for i in range(1, 101)]
+        loop.run_until_complete([controller(c) for c in casus])
+
+    Getters and setters are those of :py:class:`Casu` (commands are sent without
+    blocking). The methods that wait for data (connect, next_update and
+    wait_for_update, see :py:class:`eventloop.AsyncDevice`) return futures,
+    to be yielded from generator coroutines (Python 2.7 has no asyncio,
+    see :py:mod:`eventloop`).
+
+    :param loop: The :py:class:`eventloop.Loop` running the controllers.
+    :param string rtc_file_name: Name of the RTC file, see :py:class:`Casu`.
+    :param string name: Casu name, see :py:class:`Casu`.
+    :param string sub_addr: Data source publisher address, used with `name`.
+    :param string pub_addr: Data source command subscriber address, used with `name`.
+    :param kwargs: Other :py:class:`Casu` parameters (e.g. `log`), except `hub`.
+    """
+
+    def __init__(self, loop, rtc_file_name = 'casu.rtc', name = '',
+                 sub_addr = 'tcp://127.0.0.1:5555', pub_addr = 'tcp://127.0.0.1:5556', **kwargs):
+        socket_options = kwargs.get('socket_options')
+        latest_only = kwargs.get('latest_only', False)
+        if not name:
+            with open(rtc_file_name) as rtc_file:
+                rtc = yaml.safe_load(rtc_file)
+            sub_addr = rtc['sub_addr']
+            pub_addr = rtc['pub_addr']
+            # Merged as in Casu
+            if rtc.get('socket_options'):
+                socket_options = dict(rtc['socket_options'], **(socket_options or {}))
+            latest_only = latest_only or rtc.get('latest_only', False)
+        eventloop.AsyncDevice.__init__(self, loop, ['ir_raw', 'temp', 'fft_freq'])
+        kwargs['hub'] = loop.hub(sub_addr, pub_addr, socket_options, latest_only)
+        kwargs['wait'] = False
+        Casu.__init__(self, rtc_file_name, name, **kwargs)
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Log writers for CASU data.
+
+All writers accept rows of the form [dataid, timestamp, value, value, ...],
+the format expected by :py:func:`aggregate_data.load_from_csv`.
+"""
+
+import threading
+import collections
+import struct
+import csv
+import os
+
+class CsvLog:
+    """
+    Synchronous log writer, producing semicolon-separated text.
+
+    :param string path: Name of the logfile.
+    """
+
+    def __init__(self, path):
+        self.__file = open(path, 'wb')
+        self.__writer = csv.writer(self.__file, delimiter=';')
+
+    def write(self, row):
+        """
+        Write one row.
+        """
+        self.__writer.writerow(row)
+
+    def write_rows(self, rows):
+        """
+        Write a batch of rows.
+        """
+        self.__writer.writerows(rows)
+
+    def flush(self):
+        """
+        Flush written rows to the disk.
+        """
+        self.__file.flush()
+
+    def close(self):
+        """
+        Close the logfile.
+        """
+        self.__file.close()
+
+class BinaryLog:
+    """
+    Log writer producing fixed-width binary records.
+
+    The log is a folder, holding one file per stream id and row width,
+    named 'dataid.width.f8'. Each record consists of the timestamp and
+    the row values, stored as little-endian 64-bit floats.
+    Non-numeric values (e.g. the on/off flags of actuator setpoints)
+    are converted with float().
+
+    :param string path: Name of the log folder (created if it does not exist).
+    """
+
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        self.__path = path
+        self.__files = {}
+        self.__formats = {}
+
+    def write(self, row):
+        """
+        Write one row.
+        """
+        width = len(row) - 2
+        key = (row[0], width)
+        f = self.__files.get(key)
+        if f is None:
+            filename = '{0}.{1}.f8'.format(row[0].replace(' ', '_'), width)
+            f = open(os.path.join(self.__path, filename), 'ab', 65536)
+            self.__files[key] = f
+        fmt = self.__formats.get(width)
+        if fmt is None:
+            fmt = struct.Struct('<{0}d'.format(width + 1))
+            self.__formats[width] = fmt
+        f.write(fmt.pack(*[float(x) for x in row[1:]]))
+
+    def write_rows(self, rows):
+        """
+        Write a batch of rows.
+        """
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        """
+        Flush written rows to the disk.
+        """
+        for f in self.__files.values():
+            f.flush()
+
+    def close(self):
+        """
+        Close all stream files.
+        """
+        for f in self.__files.values():
+            f.close()
+        self.__files = {}
+
+class BufferedLog:
+    """
+    Non-blocking log writer.
+
+    Rows are pushed into a bounded ring buffer and written by a background
+    thread in large batches, so that file I/O does not stall the caller
+    (i.e. the Casu receive thread).
+
+    :param log: The underlying writer (:py:class:`CsvLog` or :py:class:`BinaryLog`).
+    :param int size: Capacity of the ring buffer, in rows.
+    :param float flush_interval: Maximum time (in seconds) a row stays in the buffer.
+    :param string policy: What to do when the buffer is full: 'drop' discards
+                          the oldest buffered row, 'block' waits for the writer thread.
+    """
+
+    def __init__(self, log, size = 10000, flush_interval = 1.0, policy = 'drop'):
+
+        if policy not in ['drop', 'block']:
+            raise ValueError("Unknown log buffer policy {0}! Use 'drop' or 'block'.".format(policy))
+
+        self.__log = log
+        self.__size = size
+        # Fill level at which the writer thread starts writing
+        self.__threshold = max(size // 2, 1)
+        self.__flush_interval = flush_interval
+        self.__block = (policy == 'block')
+
+        self.__buffer = collections.deque(maxlen = size)
+        self.__cond = threading.Condition(threading.Lock())
+        self.__dropped = 0
+        self.__written = 0
+        self.__stop = False
+
+        self.__writer_thread = threading.Thread(target=self.__write_batches)
+        self.__writer_thread.daemon = True
+        self.__writer_thread.start()
+
+    def write(self, row):
+        """
+        Queue one row for writing.
+        """
+        with self.__cond:
+            if len(self.__buffer) == self.__size:
+                if self.__block:
+                    while len(self.__buffer) == self.__size and not self.__stop:
+                        self.__cond.notify_all()
+                        self.__cond.wait()
+                else:
+                    # The deque discards the oldest row
+                    self.__dropped += 1
+            self.__buffer.append(row)
+            if len(self.__buffer) == self.__threshold:
+                # Do not wait for the flush interval
+                self.__cond.notify_all()
+
+    def dropped(self):
+        """
+        Returns the number of rows dropped because the buffer was full.
+        """
+        return self.__dropped
+
+    def written(self):
+        """
+        Returns the number of rows passed on to the underlying writer.
+        """
+        return self.__written
+
+    def close(self):
+        """
+        Write all buffered rows and close the underlying writer.
+        """
+        with self.__cond:
+            self.__stop = True
+            self.__cond.notify_all()
+        self.__writer_thread.join()
+        self.__log.close()
+
+    def __write_batches(self):
+        """
+        Drain the buffer into the underlying writer.
+        """
+        while True:
+            with self.__cond:
+                if len(self.__buffer) < self.__threshold and not self.__stop:
+                    self.__cond.wait(self.__flush_interval)
+                batch = list(self.__buffer)
+                self.__buffer.clear()
+                stop = self.__stop
+                # Release writers blocked on a full buffer
+                self.__cond.notify_all()
+            if batch:
+                self.__log.write_rows(batch)
+                self.__log.flush()
+                self.__written += len(batch)
+            if stop:
+                break
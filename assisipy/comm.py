@@ -0,0 +1,611 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Shared communication infrastructure for the assisipy device interfaces. """
+
+import threading
+import collections
+import traceback
+import Queue
+import time
+import sys
+
+import zmq
+
+POLL_TIMEOUT = 100
+"""
+Receive loop poll timeout, in milliseconds. Bounds the delay
+of (un)subscriptions and of stopping the hub.
+"""
+
+Reading = collections.namedtuple('Reading', ['seq', 'timestamp', 'values'])
+"""
+Immutable snapshot of one sensor stream.
+
+seq counts the received frames of the stream (0 before the first one),
+timestamp is the receive time and values is a tuple of sensor values.
+Snapshots are replaced, never modified, by the receive thread,
+so they can be read without locking.
+"""
+
+EMPTY_READING = Reading(0, None, ())
+"""
+Snapshot of a stream that has not been received yet.
+"""
+
+SOCKET_OPTIONS = ['sndhwm', 'rcvhwm', 'linger', 'tcp_keepalive',
+                  'tcp_keepalive_idle', 'tcp_keepalive_intvl', 'tcp_keepalive_cnt']
+"""
+Names of the ZMQ socket options accepted by :py:func:`configure_socket`.
+"""
+
+SOCKET_ROLES = ['sub', 'pub', 'msg_sub', 'msg_pub']
+"""
+Socket roles, for role-specific socket options: sensor data subscriber,
+command publisher, and inter-CASU message subscriber and publisher.
+"""
+
+def configure_socket(socket, options, role = None):
+    """
+    Apply socket options. Must be called before the socket is connected.
+
+    Options are given as a dictionary by (lowercase) ZMQ option name, e.g.::
+
+        {'rcvhwm': 100, 'linger': 0, 'tcp_keepalive': 1,
+         'pub': {'sndhwm': 10}}
+
+    Options for a single socket role (see SOCKET_ROLES) can be nested
+    under the role name, and take precedence over the common options.
+
+    :param options: Options dictionary, or None.
+    :param string role: Role of the socket.
+    :return: The socket.
+    """
+    if not options:
+        return socket
+    values = dict([(name, value) for (name, value) in options.items()
+                   if name not in SOCKET_ROLES])
+    if role in options:
+        values.update(options[role])
+    for (name, value) in values.items():
+        if name not in SOCKET_OPTIONS:
+            raise ValueError('Unknown socket option {0}!'.format(name))
+        socket.setsockopt(getattr(zmq, name.upper()), value)
+    return socket
+
+SENSOR_DEVICES = ['IR', 'Temp', 'Fft', 'Light', 'Object', 'Base']
+"""
+Devices (second message frame) sending periodic sensor readings,
+of which a latest-only receiver may skip stale frames, see :py:func:`drain`.
+"""
+
+def drain(socket, handler, latest_only = False):
+    """
+    Receive all queued multipart messages and pass them to handler(\*frames).
+
+    :param bool latest_only: If True, only the latest of the queued sensor
+        frames (see SENSOR_DEVICES) with the same (name, dev, cmd) header is
+        passed on, so that a receiver that can not keep up skips stale frames
+        instead of falling behind. Frames are passed on in the order of their
+        (latest) arrival, and other frames (e.g. setpoint echoes) are never
+        dropped. (ZMQ_CONFLATE can not be used instead, as it does not support
+        multipart messages.)
+    """
+    latest = collections.OrderedDict()
+    while True:
+        try:
+            frames = socket.recv_multipart(zmq.NOBLOCK)
+        except zmq.Again:
+            break
+        if latest_only:
+            if len(frames) > 1 and frames[1] in SENSOR_DEVICES:
+                key = tuple(frames[:3])
+                # Move the header to the end, to keep the arrival order
+                latest.pop(key, None)
+            else:
+                key = object()
+            latest[key] = frames
+        else:
+            handler(*frames)
+    for frames in latest.values():
+        handler(*frames)
+
+class ConnectionTimeout(Exception):
+    """
+    Raised when a device object does not receive data within the given timeout.
+    """
+    pass
+
+def wait_for(event, timeout, message):
+    """
+    Wait until event is set.
+
+    :param threading.Event event: The event to wait for.
+    :param float timeout: Timeout in seconds, or None to wait forever.
+    :param string message: Message of the ConnectionTimeout exception
+                           raised when the timeout expires.
+    """
+    if timeout is None:
+        # A wait without timeout can not be interrupted with Ctrl-C in Python 2,
+        # so wake up periodically
+        while not event.wait(1):
+            pass
+    elif not event.wait(timeout):
+        raise ConnectionTimeout(message)
+
+class Connection:
+    """
+    Connection state of a device object, updated by its receive thread.
+
+    The object is connected once any frame has been received,
+    and populated once each of the given sensor devices has sent a frame.
+
+    :param string name: Object name, used in messages.
+    :param list devices: Sensor devices (second message frame) to wait for
+                         with wait_all, see :py:meth:`wait`.
+    """
+
+    def __init__(self, name, devices = ()):
+        self.__name = name
+        self.__connected = threading.Event()
+        self.__populated = threading.Event()
+        self.__unseen = set(devices)
+
+    def received(self, dev):
+        """
+        Record a received frame of device dev. Must be called after the
+        frame was processed, so that waiting threads see its data.
+        """
+        if not self.__populated.is_set():
+            self.__connected.set()
+            self.__unseen.discard(dev)
+            if not self.__unseen:
+                self.__populated.set()
+
+    def wait(self, timeout = None, wait_all = False, cleanup = None):
+        """
+        Wait until the object is connected (and populated, if wait_all).
+
+        :param float timeout: Timeout in seconds, or None to wait forever.
+        :param bool wait_all: Also wait until every sensor device has sent a frame.
+        :param cleanup: Called (e.g. to stop the receive thread and close the
+                        sockets) before ConnectionTimeout is raised.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        try:
+            wait_for(self.__connected, timeout,
+                     '{0} did not connect within {1} s'.format(self.__name, timeout))
+            if wait_all:
+                if deadline is not None:
+                    timeout = max(deadline - time.time(), 0)
+                wait_for(self.__populated, timeout,
+                         'Not all sensor streams of {0} were received within the timeout'.format(self.__name))
+        except ConnectionTimeout:
+            if cleanup:
+                cleanup()
+            raise
+        print('{0} connected!'.format(self.__name))
+
+def call(fn, *args):
+    """
+    Call fn(*args), printing (instead of raising) any exception,
+    so that a failing callback does not stop the calling thread.
+    """
+    try:
+        fn(*args)
+    except Exception:
+        traceback.print_exc()
+
+def submit_function(executor):
+    """
+    Returns a submit(fn, \*args) function that runs callbacks on executor.
+
+    :param executor: None to run callbacks inline (in the calling thread),
+                     an object with a submit(fn, \*args) method
+                     (e.g. :py:class:`ThreadPool` or a concurrent.futures executor),
+                     or an event loop with a call_soon_threadsafe(fn, \*args) method.
+    """
+    if executor is None:
+        return call
+    elif hasattr(executor, 'call_soon_threadsafe'):
+        return executor.call_soon_threadsafe
+    elif hasattr(executor, 'submit'):
+        return executor.submit
+    else:
+        raise ValueError('Unsupported callback executor {0}!'.format(executor))
+
+class Callbacks:
+    """
+    Per-stream callback registry of a device object.
+
+    The registry is replaced (not modified) on registration, so that
+    the receive thread can fire the callbacks without locking.
+
+    :param submit: submit(fn, \*args) function running the callbacks,
+                   see :py:func:`submit_function`.
+    """
+
+    def __init__(self, submit = call):
+        self.__callbacks = {}
+        self.__submit = submit
+
+    def add(self, stream, callback):
+        """
+        Register callback(value) for the updates of stream.
+        """
+        callbacks = dict(self.__callbacks)
+        callbacks[stream] = callbacks.get(stream, ()) + (callback,)
+        self.__callbacks = callbacks
+
+    def remove(self, stream, callback):
+        """
+        Remove a callback registered with :py:meth:`add`.
+        """
+        callbacks = dict(self.__callbacks)
+        remaining = tuple([cb for cb in callbacks.get(stream, ()) if cb != callback])
+        if remaining:
+            callbacks[stream] = remaining
+        else:
+            callbacks.pop(stream, None)
+        self.__callbacks = callbacks
+
+    def registered(self, stream):
+        """
+        Returns True if any callbacks are registered for stream.
+        """
+        return stream in self.__callbacks
+
+    def fire(self, stream, value):
+        """
+        Pass a stream update to the registered callbacks.
+        """
+        for callback in self.__callbacks.get(stream, ()):
+            self.__submit(callback, value)
+
+class ThreadPool:
+    """
+    Minimal fixed-size pool of daemon threads running submitted callbacks in FIFO order.
+
+    :param int size: Number of worker threads.
+    """
+
+    def __init__(self, size):
+        self.__queue = Queue.Queue()
+        self.__threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.__work)
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def submit(self, fn, *args):
+        """
+        Queue fn(\*args) for execution by one of the workers.
+        """
+        self.__queue.put((fn, args))
+
+    def shutdown(self):
+        """
+        Run the queued callbacks and stop the workers.
+        """
+        for thread in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+
+    def __work(self):
+        while True:
+            task = self.__queue.get()
+            if task is None:
+                break
+            call(task[0], *task[1])
+
+class Updates:
+    """
+    Per-stream update counters, with blocking waits for the next update.
+
+    The receive thread calls :py:meth:`notify` whenever a stream is updated,
+    and controllers block in :py:meth:`wait` instead of polling.
+
+    :param list streams: Names of the counted streams.
+    """
+
+    def __init__(self, streams):
+        self.__seqs = dict.fromkeys(streams, 0)
+        self.__cond = threading.Condition(threading.Lock())
+
+    def notify(self, stream):
+        """
+        Count one update of stream and wake up the threads waiting for it.
+        """
+        with self.__cond:
+            self.__seqs[stream] += 1
+            self.__cond.notify_all()
+
+    def seq(self, stream):
+        """
+        Returns the number of updates of stream so far.
+        """
+        return self.__seqs[stream]
+
+    def wait(self, stream, timeout = None, seq = None):
+        """
+        Wait for an update of stream.
+
+        :param float timeout: Timeout in seconds, or None to wait forever.
+        :param int seq: Wait until the update counter exceeds seq. By default,
+                        the current value is used, i.e. wait for the next update.
+                        Passing the last seen value avoids missing an update
+                        that arrived in the meantime.
+        :return: True if the stream was updated, False if the timeout expired.
+        """
+        if stream not in self.__seqs:
+            raise KeyError('Unknown stream {0}'.format(stream))
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.__cond:
+            if seq is None:
+                seq = self.__seqs[stream]
+            while self.__seqs[stream] <= seq:
+                if deadline is None:
+                    # Wake up periodically, see wait_for()
+                    self.__cond.wait(1)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.__cond.wait(remaining)
+        return True
+
+class Dispatcher:
+    """
+    Table-driven dispatch of received frames.
+
+    Maps (dev, cmd) pairs to handlers, so that new device types can be
+    plugged into a receive loop without editing it. A handler registered
+    with cmd None accepts any command of the device.
+
+    :param string owner: Name of the receiving object, used in diagnostic messages.
+    :param bool strict: If False, frames of unknown devices are silently ignored.
+    """
+
+    def __init__(self, owner, strict = True):
+        self.__owner = owner
+        self.__strict = strict
+        self.__handlers = {}
+        self.__devices = set()
+        self.__ignored = set()
+
+    def register(self, dev, cmd, handler):
+        """
+        Register handler(data) for frames of device dev with command cmd.
+        """
+        self.__handlers[(dev, cmd)] = handler
+        self.__devices.add(dev)
+        self.__ignored.discard((dev, cmd))
+        self.__ignored.discard((dev, None))
+
+    def ignore(self, dev, cmd = None):
+        """
+        Mark the frames of device dev with command cmd (or with any command,
+        if None) as ignored, until a handler is registered for them.
+        See :py:meth:`ignores`.
+        """
+        self.__ignored.add((dev, cmd))
+
+    def ignores(self, dev, cmd):
+        """
+        Returns True if frames of (dev, cmd) are ignored, i.e. should be
+        dropped by the receiver without being dispatched, recorded or logged.
+        """
+        return bool(self.__ignored) and \
+            ((dev, cmd) in self.__ignored or (dev, None) in self.__ignored)
+
+    def register_parser(self, dev, cmd, msg, lock):
+        """
+        Register a handler that parses the frame data into the protobuf
+        message msg. The write is protected with lock,
+        to make sure all data is written before access.
+        """
+        parse = msg.ParseFromString
+        def handler(data):
+            with lock:
+                parse(data)
+        self.register(dev, cmd, handler)
+
+    def dispatch(self, dev, cmd, data):
+        """
+        Pass the frame data to the handler registered for (dev, cmd).
+        """
+        handler = self.__handlers.get((dev, cmd)) or self.__handlers.get((dev, None))
+        if handler:
+            handler(data)
+        elif dev in self.__devices:
+            print('Unknown command {0} for {1}'.format(cmd, self.__owner))
+        elif self.__strict:
+            print('Unknown device {0} for {1}'.format(dev, self.__owner))
+
+class Hub:
+    """
+    Shared connection to a data source (e.g. the simulator).
+
+    A single hub multiplexes many device objects (e.g. :py:class:`casu.Casu`)
+    over one ZMQ context, one SUB socket, one PUB socket and one receive
+    thread. Each registered object gets its own name subscription, and incoming
+    frames are dispatched to it by the name frame.
+
+    Usage::
+
+        hub = comm.Hub(sub_addr = 'tcp://127.0.0.1:5555',
+                       pub_addr = 'tcp://127.0.0.1:5556')
+        casus = [casu.Casu(name = n, hub = hub) for n in names]
+
+    :param string sub_addr: Address of the data source publisher.
+    :param string pub_addr: Address of the data source command subscriber.
+    :param dict socket_options: ZMQ socket options, see :py:func:`configure_socket`.
+    :param bool latest_only: Pass on only the latest queued sensor frame of each
+                             (name, dev, cmd), see :py:func:`drain`.
+    """
+
+    def __init__(self, sub_addr = 'tcp://127.0.0.1:5555',
+                 pub_addr = 'tcp://127.0.0.1:5556',
+                 socket_options = None, latest_only = False):
+
+        self.__sub_addr = sub_addr
+        self.__pub_addr = pub_addr
+        self.__socket_options = socket_options
+        self.__latest_only = latest_only
+
+        self.__handlers = {}
+        self.__sockets = {}
+        self.__pending = []
+        self.__lock = threading.Lock()
+        self.__stop = False
+
+        self.__context = zmq.Context(1)
+
+        # Connect the shared command publisher socket
+        self.__pub = configure_socket(self.__context.socket(zmq.PUB), socket_options, 'pub')
+        self.__pub_lock = threading.Lock()
+        try:
+            self.__pub.connect(self.__pub_addr)
+        except zmq.error.ZMQError:
+            print('CONNECTION ERROR: Failed to connect to {0}'.format(self.__pub_addr))
+            sys.exit(1)
+
+        # Create the data update thread
+        self.__comm_thread = threading.Thread(target=self.__update_readings)
+        self.__comm_thread.daemon = True
+        self.__comm_thread.start()
+
+    def context(self):
+        """
+        Returns the ZMQ context shared by all objects using this hub.
+        """
+        return self.__context
+
+    def register(self, name, handler):
+        """
+        Subscribe to the frames of object name.
+
+        :param string name: Object name (the first frame of its messages).
+        :param handler: Callable invoked from the receive thread
+                        as handler(name, dev, cmd, data).
+        """
+        with self.__lock:
+            self.__handlers[name] = handler
+            self.__pending.append(('subscribe', name))
+
+    def unregister(self, name):
+        """
+        Stop receiving the frames of object name.
+        """
+        with self.__lock:
+            self.__handlers.pop(name, None)
+            self.__pending.append(('unsubscribe', name))
+
+    def add_socket(self, socket, handler):
+        """
+        Poll an additional socket from the receive thread.
+
+        The socket must not be used from any other thread after it has been
+        added. handler(socket) is called whenever the socket is readable.
+        """
+        with self.__lock:
+            self.__pending.append(('add', (socket, handler)))
+
+    def remove_socket(self, socket, close = False):
+        """
+        Stop polling a socket added with :py:meth:`add_socket`.
+
+        :param bool close: Also close the socket, once it is no longer polled.
+        """
+        with self.__lock:
+            self.__pending.append(('remove', (socket, close)))
+
+    def send(self, frames):
+        """
+        Send a multipart message through the shared publisher socket.
+        """
+        with self.__pub_lock:
+            self.__pub.send_multipart(frames)
+
+    def send_many(self, messages):
+        """
+        Send several multipart messages, with one lock acquisition.
+        """
+        with self.__pub_lock:
+            for frames in messages:
+                self.__pub.send_multipart(frames)
+
+    def stop(self):
+        """
+        Stops the receive thread and closes the shared sockets.
+        """
+        self.__stop = True
+        self.__comm_thread.join()
+        self.__pub.close()
+
+    def __apply_pending(self, poller):
+        """
+        Apply (un)subscriptions and socket changes requested by other threads.
+        ZMQ sockets are not thread safe, so this is done within the receive thread.
+        """
+        with self.__lock:
+            pending = self.__pending
+            self.__pending = []
+        for (action, arg) in pending:
+            if action == 'subscribe':
+                self.__sub.setsockopt(zmq.SUBSCRIBE, arg)
+            elif action == 'unsubscribe':
+                self.__sub.setsockopt(zmq.UNSUBSCRIBE, arg)
+            elif action == 'add':
+                (socket, handler) = arg
+                self.__sockets[socket] = handler
+                poller.register(socket, zmq.POLLIN)
+            elif action == 'remove':
+                (socket, close) = arg
+                if self.__sockets.pop(socket, None):
+                    poller.unregister(socket)
+                if close:
+                    socket.close()
+
+    def __update_readings(self):
+        """
+        Receive data for all registered objects and dispatch it by name.
+        """
+        self.__sub = configure_socket(self.__context.socket(zmq.SUB),
+                                      self.__socket_options, 'sub')
+        try:
+            self.__sub.connect(self.__sub_addr)
+        except zmq.error.ZMQError:
+            print('CONNECTION ERROR: Failed to connect to {0}'.format(self.__sub_addr))
+            sys.exit(1) # TODO: This might have some issues, as we're within a thread
+
+        poller = zmq.Poller()
+        poller.register(self.__sub, zmq.POLLIN)
+
+        while not self.__stop:
+            if self.__pending:
+                self.__apply_pending(poller)
+            ready = dict(poller.poll(POLL_TIMEOUT))
+            if self.__sub in ready:
+                # Drain everything that is queued
+                drain(self.__sub, self.__dispatch, self.__latest_only)
+            for socket in ready:
+                if socket in self.__sockets:
+                    self.__sockets[socket](socket)
+
+        self.__sub.close()
+
+    def __dispatch(self, *frames):
+        """
+        Pass a received message to the handler of its object.
+        """
+        # Subscriptions are prefix-based, so match the name exactly
+        handler = self.__handlers.get(frames[0])
+        if handler:
+            handler(*frames)
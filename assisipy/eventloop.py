@@ -0,0 +1,661 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Single-threaded event loop for running many device controllers in one process.
+
+assisipy targets Python 2.7, which has neither asyncio nor zmq.asyncio,
+so coroutines are plain generators that yield futures (in the style
+of the Tornado and Trollius generator coroutines)::
+
+    def controller(c):
+        yield c.connect()
+        while True:
+            reading = yield c.next_update('temp')
+            if max(reading.values) > 30:
+                c.set_diagnostic_led_rgb(r = 1)
+
+    loop = eventloop.Loop()
+    casus = [casu.AsyncCasu(loop, name = n) for n in names]
+    loop.run_until_complete([loop.spawn(controller(c)) for c in casus])
+
+A coroutine may also yield a list of futures (to wait for all of them)
+or None (to let other coroutines run), and returns a value by raising
+:py:class:`Return`. All loop objects must be used from the thread
+running the loop, except for :py:meth:`Loop.call_soon_threadsafe`.
+"""
+
+import collections
+import functools
+import itertools
+import threading
+import heapq
+import time
+import types
+
+import zmq
+
+from comm import ConnectionTimeout, call, configure_socket, drain
+
+class Return(Exception):
+    """
+    Raised by a coroutine to return a value.
+    """
+    def __init__(self, value = None):
+        Exception.__init__(self, value)
+        self.value = value
+
+class TimeoutError(Exception):
+    """
+    Raised when a future does not complete within the timeout of :py:meth:`Loop.with_timeout`.
+    """
+    pass
+
+class CancelledError(Exception):
+    """
+    Raised by the result of a cancelled future, see :py:meth:`Future.cancel`.
+    """
+    pass
+
+class Future:
+    """
+    The result of an operation that has not completed yet.
+    """
+
+    def __init__(self):
+        self.__done = False
+        self.__result = None
+        self.__exception = None
+        self.__callbacks = []
+
+    def done(self):
+        """
+        Returns True if the result (or exception) has been set.
+        """
+        return self.__done
+
+    def result(self):
+        """
+        Returns the result, or raises the exception of the operation.
+        """
+        if not self.__done:
+            raise RuntimeError('The future is not done yet!')
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__result
+
+    def exception(self):
+        """
+        Returns the exception of the operation, or None.
+        """
+        return self.__exception
+
+    def cancelled(self):
+        """
+        Returns True if the future was cancelled.
+        """
+        return isinstance(self.__exception, CancelledError)
+
+    def cancel(self):
+        """
+        Fail the future with :py:class:`CancelledError`, e.g. when its
+        result is no longer needed. Has no effect if it is already done.
+
+        :return: True if the future was cancelled.
+        """
+        if self.__done:
+            return False
+        self.set_exception(CancelledError())
+        return True
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(future) once the future is done.
+        """
+        if self.__done:
+            call(callback, self)
+        else:
+            self.__callbacks.append(callback)
+
+    def set_result(self, value):
+        """
+        Complete the future. Has no effect if it is already done (e.g. timed out).
+        """
+        if not self.__done:
+            self.__result = value
+            self.__finish()
+
+    def set_exception(self, exception):
+        """
+        Fail the future. Has no effect if it is already done.
+        """
+        if not self.__done:
+            self.__exception = exception
+            self.__finish()
+
+    def __finish(self):
+        self.__done = True
+        callbacks = self.__callbacks
+        self.__callbacks = []
+        for callback in callbacks:
+            call(callback, self)
+
+def gather(futures):
+    """
+    Returns a future of the list of results of all futures.
+    It fails with the first exception raised by any of them.
+    """
+    futures = list(futures)
+    result = Future()
+    if not futures:
+        result.set_result([])
+    def on_done(future):
+        if future.exception() is not None:
+            result.set_exception(future.exception())
+        elif all([f.done() for f in futures]):
+            result.set_result([f.result() for f in futures])
+    for future in futures:
+        future.add_done_callback(on_done)
+    return result
+
+def first(futures):
+    """
+    Returns a future of the result of the first of futures to complete.
+    """
+    result = Future()
+    def on_done(future):
+        if future.exception() is not None:
+            result.set_exception(future.exception())
+        else:
+            result.set_result(future.result())
+    for future in futures:
+        future.add_done_callback(on_done)
+    return result
+
+class Task(Future):
+    """
+    Runs a generator coroutine on the loop. The task completes
+    with the value returned by the coroutine.
+    """
+
+    def __init__(self, loop, coroutine):
+        Future.__init__(self)
+        self.__loop = loop
+        self.__coroutine = coroutine
+        loop.call_soon(self.__step, None, None)
+
+    def __step(self, value, exception):
+        """
+        Resume the coroutine until it yields the next future.
+        """
+        try:
+            if exception is not None:
+                yielded = self.__coroutine.throw(exception)
+            else:
+                yielded = self.__coroutine.send(value)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Return as r:
+            self.set_result(r.value)
+            return
+        except Exception as e:
+            self.set_exception(e)
+            return
+
+        if isinstance(yielded, list):
+            yielded = gather(yielded)
+        if yielded is None:
+            self.__loop.call_soon(self.__step, None, None)
+        elif isinstance(yielded, Future):
+            yielded.add_done_callback(self.__wakeup)
+        else:
+            self.__loop.call_soon(self.__step, None,
+                                  TypeError('Coroutines must yield futures, not {0}'.format(yielded)))
+
+    def __wakeup(self, future):
+        # Resume from the loop, to avoid deep recursion through chains of futures
+        if future.exception() is not None:
+            self.__loop.call_soon(self.__step, None, future.exception())
+        else:
+            self.__loop.call_soon(self.__step, future.result(), None)
+
+_TIMER_COMPACT_MIN = 100
+"""
+Minimum number of cancelled timers before the timer heap of a loop is compacted.
+"""
+
+class Timer:
+    """
+    Handle of a callback scheduled with :py:meth:`Loop.call_later`.
+
+    :param on_cancel: Called when a scheduled timer is cancelled.
+    """
+
+    def __init__(self, when, callback, args, on_cancel = None):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.done = False
+        self.__on_cancel = on_cancel
+
+    def cancel(self):
+        """
+        Do not run the callback.
+        """
+        if not self.cancelled and not self.done:
+            self.cancelled = True
+            if self.__on_cancel:
+                self.__on_cancel()
+
+class Loop:
+    """
+    Event loop multiplexing ZMQ sockets, timers and coroutines in one thread.
+
+    :param context: ZMQ context for the sockets of the loop (a new one by default).
+    """
+
+    def __init__(self, context = None):
+        self.__context = context or zmq.Context(1)
+        self.__poller = zmq.Poller()
+        self.__readers = {}
+        self.__ready = collections.deque()
+        self.__timers = []
+        self.__timer_ids = itertools.count()
+        self.__cancelled_timers = 0
+        self.__hubs = {}
+        self.__stop = False
+
+        # Wakeup channel for callbacks scheduled from other threads
+        self.__lock = threading.Lock()
+        self.__threadsafe = []
+        address = 'inproc://assisipy-loop-{0}'.format(id(self))
+        self.__wake_recv = self.__context.socket(zmq.PAIR)
+        self.__wake_recv.bind(address)
+        self.__wake_send = self.__context.socket(zmq.PAIR)
+        self.__wake_send.connect(address)
+        self.add_reader(self.__wake_recv, self.__on_wake)
+
+    def context(self):
+        """
+        Returns the ZMQ context of the loop.
+        """
+        return self.__context
+
+    def call_soon(self, callback, *args):
+        """
+        Run callback(\\*args) in the next loop iteration.
+        """
+        self.__ready.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        """
+        Run callback(\\*args) after delay seconds.
+
+        :return: A :py:class:`Timer`, which can be cancelled.
+        """
+        timer = Timer(time.time() + delay, callback, args, self.__timer_cancelled)
+        heapq.heappush(self.__timers, (timer.when, next(self.__timer_ids), timer))
+        return timer
+
+    def __timer_cancelled(self):
+        """
+        Count a cancelled timer, and drop the cancelled timers from the heap
+        once they make up most of it, so that timers cancelled long before
+        their deadline (e.g. timeouts of completed waits) do not pile up.
+        """
+        self.__cancelled_timers += 1
+        if self.__cancelled_timers >= _TIMER_COMPACT_MIN and \
+           self.__cancelled_timers * 2 > len(self.__timers):
+            self.__timers = [entry for entry in self.__timers if not entry[2].cancelled]
+            heapq.heapify(self.__timers)
+            self.__cancelled_timers = 0
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Run callback(\\*args) in the loop thread. May be called from any thread,
+        so the loop can be used as the executor of :py:meth:`casu.Casu.on`.
+        """
+        with self.__lock:
+            self.__threadsafe.append((callback, args))
+            try:
+                self.__wake_send.send('', zmq.NOBLOCK)
+            except zmq.Again:
+                # A wakeup is already pending
+                pass
+
+    def add_reader(self, socket, callback):
+        """
+        Call callback(socket) whenever the socket is readable.
+        """
+        self.__readers[socket] = callback
+        self.__poller.register(socket, zmq.POLLIN)
+
+    def remove_reader(self, socket):
+        """
+        Stop watching a socket added with :py:meth:`add_reader`.
+        """
+        if self.__readers.pop(socket, None):
+            self.__poller.unregister(socket)
+
+    def spawn(self, coroutine):
+        """
+        Start running a generator coroutine.
+
+        :return: The :py:class:`Task` running the coroutine.
+        """
+        if not isinstance(coroutine, types.GeneratorType):
+            raise TypeError('{0} is not a generator coroutine!'.format(coroutine))
+        return Task(self, coroutine)
+
+    def sleep(self, delay, result = None):
+        """
+        Returns a future completed with result after delay seconds.
+        """
+        future = Future()
+        self.call_later(delay, future.set_result, result)
+        return future
+
+    def with_timeout(self, future, timeout):
+        """
+        Returns a future of the result of future, failing with
+        :py:class:`TimeoutError` if it does not complete within timeout seconds.
+        """
+        if timeout is None:
+            return future
+        result = first([future])
+        timer = self.call_later(timeout, result.set_exception,
+                                TimeoutError('Timed out after {0} s'.format(timeout)))
+        result.add_done_callback(lambda f: timer.cancel())
+        return result
+
+    def hub(self, sub_addr = 'tcp://127.0.0.1:5555', pub_addr = 'tcp://127.0.0.1:5556',
+            socket_options = None, latest_only = False):
+        """
+        Returns the :py:class:`LoopHub` connected to the given data source
+        addresses, creating it on first use (the socket options and
+        `latest_only` of the first call are used, see :py:class:`comm.Hub`).
+        """
+        key = (sub_addr, pub_addr)
+        if key not in self.__hubs:
+            self.__hubs[key] = LoopHub(self, sub_addr, pub_addr, socket_options, latest_only)
+        return self.__hubs[key]
+
+    def run_forever(self):
+        """
+        Run the loop until :py:meth:`stop` is called.
+        """
+        self.__stop = False
+        while not self.__stop:
+            self.__run_once()
+
+    def run_until_complete(self, future):
+        """
+        Run the loop until future is done, and return its result.
+
+        :param future: A future, a generator coroutine or a list of them.
+        """
+        if isinstance(future, list):
+            future = gather([self.__as_future(f) for f in future])
+        else:
+            future = self.__as_future(future)
+        future.add_done_callback(lambda f: self.stop())
+        if not future.done():
+            self.run_forever()
+        return future.result()
+
+    def stop(self):
+        """
+        Stop the loop after the current iteration.
+        """
+        self.__stop = True
+
+    def close(self):
+        """
+        Close the sockets of the loop and of its hubs.
+        """
+        for hub in self.__hubs.values():
+            hub.stop()
+        self.__hubs = {}
+        self.remove_reader(self.__wake_recv)
+        self.__wake_recv.close()
+        self.__wake_send.close()
+
+    def __as_future(self, future):
+        if isinstance(future, Future):
+            return future
+        return self.spawn(future)
+
+    def __on_wake(self, socket):
+        while True:
+            try:
+                socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        with self.__lock:
+            self.__ready.extend(self.__threadsafe)
+            self.__threadsafe = []
+
+    def __run_once(self):
+        """
+        Poll the sockets, then run due timers and ready callbacks.
+        """
+        timeout = 1000 # Wake up periodically, so that Ctrl-C works
+        if self.__ready:
+            timeout = 0
+        elif self.__timers:
+            timeout = min(timeout, max(0, (self.__timers[0][0] - time.time()) * 1000))
+        for (socket, event) in self.__poller.poll(timeout):
+            reader = self.__readers.get(socket)
+            if reader:
+                call(reader, socket)
+
+        now = time.time()
+        while self.__timers and self.__timers[0][0] <= now:
+            timer = heapq.heappop(self.__timers)[2]
+            if timer.cancelled:
+                self.__cancelled_timers -= 1
+            else:
+                timer.done = True
+                self.__ready.append((timer.callback, timer.args))
+
+        # Callbacks scheduled now run in the next iteration
+        for i in range(len(self.__ready)):
+            (callback, args) = self.__ready.popleft()
+            call(callback, *args)
+
+class LoopHub:
+    """
+    Data source connection driven by a :py:class:`Loop` instead of a thread.
+
+    Implements the :py:class:`comm.Hub` interface, so it can be passed as the
+    `hub` argument of device objects (as done by :py:class:`casu.AsyncCasu`).
+    Frames are dispatched, and handlers run, in the loop thread.
+    Use :py:meth:`Loop.hub` to create it.
+    """
+
+    def __init__(self, loop, sub_addr, pub_addr, socket_options = None, latest_only = False):
+        self.__loop = loop
+        self.__handlers = {}
+        self.__latest_only = latest_only
+        context = loop.context()
+
+        self.__pub = configure_socket(context.socket(zmq.PUB), socket_options, 'pub')
+        self.__pub.connect(pub_addr)
+        self.__sub = configure_socket(context.socket(zmq.SUB), socket_options, 'sub')
+        self.__sub.connect(sub_addr)
+        loop.add_reader(self.__sub, self.__receive)
+
+    def context(self):
+        """
+        Returns the ZMQ context of the loop.
+        """
+        return self.__loop.context()
+
+    def register(self, name, handler):
+        """
+        Subscribe to the frames of object name, see :py:meth:`comm.Hub.register`.
+        """
+        self.__handlers[name] = handler
+        self.__sub.setsockopt(zmq.SUBSCRIBE, name)
+
+    def unregister(self, name):
+        """
+        Stop receiving the frames of object name.
+        """
+        if self.__handlers.pop(name, None):
+            self.__sub.setsockopt(zmq.UNSUBSCRIBE, name)
+
+    def add_socket(self, socket, handler):
+        """
+        Call handler(socket) from the loop whenever the socket is readable.
+        """
+        self.__loop.add_reader(socket, handler)
+
+    def remove_socket(self, socket, close = False):
+        """
+        Stop polling a socket added with :py:meth:`add_socket`.
+
+        :param bool close: Also close the socket.
+        """
+        self.__loop.remove_reader(socket)
+        if close:
+            socket.close()
+
+    def send(self, frames):
+        """
+        Send a multipart message to the data source.
+        """
+        self.__pub.send_multipart(frames)
+
+    def send_many(self, messages):
+        """
+        Send several multipart messages to the data source.
+        """
+        for frames in messages:
+            self.__pub.send_multipart(frames)
+
+    def stop(self):
+        """
+        Close the sockets of the hub.
+        """
+        self.__loop.remove_reader(self.__sub)
+        self.__sub.close()
+        self.__pub.close()
+
+    def __receive(self, socket):
+        # Drain everything that is queued
+        drain(socket, self.__dispatch, self.__latest_only)
+
+    def __dispatch(self, *frames):
+        # Subscriptions are prefix-based, so match the name exactly
+        handler = self.__handlers.get(frames[0])
+        if handler:
+            handler(*frames)
+
+class AsyncDevice:
+    """
+    Mixin for device classes driven by a :py:class:`Loop`
+    (:py:class:`casu.AsyncCasu` and :py:class:`bee.AsyncBee`), providing
+    the methods that wait for data as futures.
+
+    The device class provides name(), streams(), get_seq(stream)
+    and on(stream, callback).
+
+    :param loop: The :py:class:`Loop` running the device controllers.
+    :param list sensor_streams: Streams continuously sent by a connected device,
+                                used by :py:meth:`connect`.
+    """
+
+    def __init__(self, loop, sensor_streams):
+        self.__loop = loop
+        self.__sensor_streams = sensor_streams
+        self.__waiters = {}
+
+    def connect(self, timeout = None, wait_all = False):
+        """
+        Returns a future completed once the device is connected.
+
+        :param float timeout: Maximum time to wait (in seconds). If it expires,
+                              the future fails with :py:class:`comm.ConnectionTimeout`.
+        :param bool wait_all: Also wait until every (processed) sensor stream has been received.
+        """
+        streams = [stream for stream in self.__sensor_streams
+                   if stream in self.streams()] or self.streams()
+        pending = [self.next_update(stream) for stream in streams
+                   if self.get_seq(stream) == 0]
+        if len(pending) < len(streams) and not (wait_all and pending):
+            connected = Future()
+            connected.set_result(None)
+        elif wait_all:
+            connected = gather(pending)
+        else:
+            connected = first(pending)
+
+        result = Future()
+        def on_done(future):
+            # Stop waiting for the streams that were not needed
+            for update in pending:
+                update.cancel()
+            if isinstance(future.exception(), TimeoutError):
+                result.set_exception(ConnectionTimeout(
+                    '{0} did not connect within {1} s'.format(self.name(), timeout)))
+            elif future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                print('{0} connected!'.format(self.name()))
+                result.set_result(None)
+        self.__loop.with_timeout(connected, timeout).add_done_callback(on_done)
+        return result
+
+    def next_update(self, stream):
+        """
+        Returns a future of the next update of stream, i.e. the value passed
+        to callbacks registered with on(). The future can be cancelled
+        if the update is no longer needed.
+
+        :param string stream: Stream name, see get_seq().
+        """
+        future = Future()
+        if stream not in self.__waiters:
+            self.__waiters[stream] = []
+            self.on(stream, functools.partial(self.__resolve, stream))
+        self.__waiters[stream].append(future)
+        future.add_done_callback(functools.partial(self.__discard, stream))
+        return future
+
+    def wait_for_update(self, stream, timeout = None, seq = None):
+        """
+        Returns a future that completes with True on the next update of stream
+        (or immediately, if the stream is already newer than seq),
+        or with False if the timeout expires.
+        """
+        if seq is not None and self.get_seq(stream) > seq:
+            result = Future()
+            result.set_result(True)
+            return result
+        update = self.next_update(stream)
+        result = Future()
+        def on_done(future):
+            # Do not keep waiting after a timeout
+            update.cancel()
+            result.set_result(future.exception() is None)
+        self.__loop.with_timeout(update, timeout).add_done_callback(on_done)
+        return result
+
+    def __discard(self, stream, future):
+        """
+        Remove a cancelled future from the waiters of stream.
+        """
+        if future.cancelled() and future in self.__waiters[stream]:
+            self.__waiters[stream].remove(future)
+
+    def __resolve(self, stream, value):
+        """
+        Complete the futures waiting for an update of stream.
+        """
+        waiters = self.__waiters[stream]
+        self.__waiters[stream] = []
+        for future in waiters:
+            future.set_result(value)
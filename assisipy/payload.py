@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compact binary encoding of numeric inter-CASU message payloads.
+
+Payloads are numeric vectors (sequences of numbers) or mappings of string
+keys to numbers. All numbers are sent as little-endian 64-bit floats::
+
+    vector  = 'V' | value*
+    mapping = 'M' | key block length (uint32) | keys ('\\0'-separated) | value*
+
+See :py:meth:`casu.Casu.send_data`.
+"""
+
+import struct
+
+VECTOR = 'V'
+MAPPING = 'M'
+
+_LENGTH = struct.Struct('<I')
+
+def pack(data):
+    """
+    Encode a payload.
+
+    :param data: A sequence of numbers, or a dictionary of numbers by string key.
+    :return: The encoded payload (string).
+    """
+    if hasattr(data, 'items'):
+        keys = [str(key) for key in data.keys()]
+        if any([not key or '\0' in key for key in keys]):
+            raise ValueError('Payload keys must be non-empty strings without null characters!')
+        keyblock = '\0'.join(keys)
+        values = [data[key] for key in data.keys()]
+        return ''.join([MAPPING, _LENGTH.pack(len(keyblock)), keyblock,
+                        struct.pack('<{0}d'.format(len(values)), *values)])
+    else:
+        data = list(data)
+        return VECTOR + struct.pack('<{0}d'.format(len(data)), *data)
+
+def unpack(payload):
+    """
+    Decode a payload. The values are unpacked directly from the received
+    string, without intermediate copies.
+
+    :return: A tuple of floats, or a dictionary of floats by key.
+    :raises ValueError: If the payload is of unknown type, or its length does
+                        not match its values (e.g. a corrupt message).
+    """
+    kind = payload[:1]
+    if kind == VECTOR:
+        (count, rest) = divmod(len(payload) - 1, 8)
+        if rest:
+            raise ValueError('Invalid vector payload length {0}'.format(len(payload)))
+        return struct.unpack_from('<{0}d'.format(count), payload, 1)
+    elif kind == MAPPING:
+        keylength = _LENGTH.unpack_from(payload, 1)[0]
+        start = 1 + _LENGTH.size
+        keys = []
+        if keylength:
+            keys = payload[start:start + keylength].split('\0')
+        if len(payload) != start + keylength + 8 * len(keys):
+            raise ValueError('Invalid mapping payload length {0}'.format(len(payload)))
+        values = struct.unpack_from('<{0}d'.format(len(keys)), payload, start + keylength)
+        return dict(zip(keys, values))
+    else:
+        raise ValueError('Unknown payload type {0}'.format(repr(kind)))
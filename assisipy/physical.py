@@ -3,12 +3,13 @@ Python API for manipulating simulated physical objects.
 """
 
 import threading
-import time
 
 import zmq
 
 from msg import base_msgs_pb2
 
+from comm import Connection, configure_socket, POLL_TIMEOUT
+
 class Object:
     """ 
     Interface to simulated physical objects. 
@@ -17,10 +18,12 @@ class Object:
 
     :param string rtc_file_name: Name of the RTC file.
     :param string name: Unique name of the spawned physical object.
+    :param float timeout: Maximum time (in seconds) to wait for the connection. If it expires, :py:class:`comm.ConnectionTimeout` is raised. By default, the constructor waits forever.
+    :param dict socket_options: ZMQ socket options, see :py:func:`comm.configure_socket`.
 
     """
     
-    def __init__(self, rtc_file_name='', name = 'object'):
+    def __init__(self, rtc_file_name='', name = 'object', timeout = None, socket_options = None):
 
         
         if rtc_file_name:
@@ -29,14 +32,16 @@ class Object:
         else:
             # Use default values
             self.__pub_addr = 'tcp://127.0.0.1:5556'
-            self.__sub_addr = 'tcp://127.0.0.1:5555',
+            self.__sub_addr = 'tcp://127.0.0.1:5555'
             self.__name = name
+            self.__socket_options = socket_options
             self.x = 0
             self.y = 0
             self.yaw = 0
 
             # Create the data update thread
-            self.__connected = False
+            self.__connection = Connection(self.__name)
+            self.__stop = False
             self.__context = zmq.Context(1)
             self.__comm_thread = threading.Thread(target=self.__update_readings)
             self.__comm_thread.daemon = True
@@ -44,28 +49,35 @@ class Object:
             self.__comm_thread.start()
 
             # Bind the publisher socket
-            self.__pub = self.__context.socket(zmq.PUB)
+            self.__pub = configure_socket(self.__context.socket(zmq.PUB),
+                                          socket_options, 'pub')
             self.__pub.connect(self.__pub_addr)
 
             # Wait for the connection
-            while not self.__connected:
-                pass
-            print('{0} connected!'.format(self.__name))
+            self.__connection.wait(timeout, cleanup = self.__close)
 
-            # Wait one more second to get all the data
-            time.sleep(1)
+    def __close(self):
+        """
+        Stop the receive thread, and close the sockets and the context.
+        """
+        self.__stop = True
+        self.__comm_thread.join()
+        self.__pub.close()
+        self.__context.term()
 
     def __update_readings(self):
         """  
         Get message from object and update data. 
         """
-        self.__sub = self.__context.socket(zmq.SUB)
+        self.__sub = configure_socket(self.__context.socket(zmq.SUB),
+                                      self.__socket_options, 'sub')
         self.__sub.connect(self.__sub_addr)
         self.__sub.setsockopt(zmq.SUBSCRIBE, self.__name)
         
-        while True:
+        while not self.__stop:
+            if not self.__sub.poll(POLL_TIMEOUT):
+                continue
             [name, dev, cmd, data] = self.__sub.recv_multipart()
-            self.__connected = True
             if dev == 'Pos':
                 if cmd == 'Get':
                     # Protect write with a lock
@@ -80,6 +92,9 @@ class Object:
                     print('Unknown command {0} from {1}'.format(ranges, self.__name))
             else:
                 print('Unknown device ir for {0}'.format(self.__name))
+            self.__connection.received(dev)
+
+        self.__sub.close()
 
 if __name__ == '__main__':
     
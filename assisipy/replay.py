@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Recording of raw data frames, and replaying them to Casu and Bee objects.
+
+A recording is an append-only file of records, each holding the receive
+timestamp and the raw [name, dev, cmd, data] multipart message::
+
+    record = timestamp (float64) | number of frames (uint32) | frame*
+    frame  = length (uint32) | bytes
+
+All numbers are little-endian. The file starts with the 8-byte MAGIC string.
+"""
+
+import threading
+import struct
+import time
+import os
+
+import zmq
+
+MAGIC = 'ASFRAME1'
+"""
+Identifier at the start of every frame recording.
+"""
+
+_RECORD = struct.Struct('<dI')
+_FRAME = struct.Struct('<I')
+
+class FrameRecorder:
+    """
+    Records raw multipart messages to an append-only file.
+
+    :param string path: Name of the recording file. If it exists, new records are appended.
+    """
+
+    def __init__(self, path):
+        self.__lock = threading.Lock()
+        self.__file = open(path, 'ab')
+        if self.__file.tell() == 0:
+            self.__file.write(MAGIC)
+
+    def record(self, frames, timestamp = None):
+        """
+        Append one multipart message.
+
+        :param list frames: The message frames (strings).
+        :param float timestamp: Receive time, defaults to the current time.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        chunks = [_RECORD.pack(timestamp, len(frames))]
+        for frame in frames:
+            chunks.append(_FRAME.pack(len(frame)))
+            chunks.append(frame)
+        with self.__lock:
+            self.__file.write(''.join(chunks))
+
+    def close(self):
+        """
+        Close the recording file.
+        """
+        with self.__lock:
+            self.__file.close()
+
+def read_frames(path):
+    """
+    Iterate over a frame recording.
+
+    An incomplete last record (e.g. from an interrupted program) is ignored.
+
+    :return: A generator of (timestamp, frames) tuples.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise IOError('{0} is not a frame recording!'.format(path))
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            (timestamp, count) = _RECORD.unpack(header)
+            frames = []
+            for i in range(count):
+                size = f.read(_FRAME.size)
+                if len(size) < _FRAME.size:
+                    return
+                length = _FRAME.unpack(size)[0]
+                frame = f.read(length)
+                if len(frame) < length:
+                    return
+                frames.append(frame)
+            yield (timestamp, frames)
+
+class Replay:
+    """
+    Data source that replays a frame recording instead of a live socket.
+
+    Implements the :py:class:`comm.Hub` interface, so it is used by passing
+    it as the `hub` argument of :py:class:`casu.Casu` or :py:class:`bee.Bee`::
+
+        source = replay.Replay('casu-001.frames', speed = 10)
+        c = casu.Casu(name = 'casu-001', hub = source)
+
+    Commands sent by the objects are discarded, and inter-CASU messages
+    are not replayed.
+
+    :param string path: Name of the recording file.
+    :param float speed: Replay speed relative to the recording time
+                        (1 is real time). If None, frames are replayed as fast as possible.
+    :param list names: Names of the objects fed from this source. The replay starts
+                       once all of them have been registered. By default, the replay
+                       starts when the first object is registered.
+    """
+
+    def __init__(self, path, speed = 1.0, names = None):
+        if not os.path.isfile(path):
+            raise IOError('Frame recording {0} does not exist!'.format(path))
+
+        self.__path = path
+        self.__speed = speed
+        self.__names = set(names or [])
+        self.__handlers = {}
+        self.__lock = threading.Lock()
+        self.__context = None
+        self.__stopped = threading.Event()
+        self.__started = threading.Event()
+        self.__done = threading.Event()
+
+        self.__replay_thread = threading.Thread(target=self.__replay)
+        self.__replay_thread.daemon = True
+        self.__replay_thread.start()
+
+    def context(self):
+        """
+        Returns a ZMQ context for sockets of the objects fed from this source.
+        """
+        with self.__lock:
+            if self.__context is None:
+                self.__context = zmq.Context(1)
+            return self.__context
+
+    def register(self, name, handler):
+        """
+        Feed the recorded frames of object name to handler(name, dev, cmd, data).
+        """
+        with self.__lock:
+            self.__handlers[name] = handler
+            if self.__names.issubset(self.__handlers):
+                self.__started.set()
+
+    def unregister(self, name):
+        """
+        Stop feeding the frames of object name.
+        """
+        with self.__lock:
+            self.__handlers.pop(name, None)
+
+    def add_socket(self, socket, handler):
+        """
+        Inter-CASU messages are not replayed, so the socket is not polled.
+        """
+        pass
+
+    def remove_socket(self, socket, close = False):
+        """
+        See :py:meth:`add_socket`.
+
+        :param bool close: Close the socket.
+        """
+        if close:
+            socket.close()
+
+    def send(self, frames):
+        """
+        Commands are discarded.
+        """
+        pass
+
+    def send_many(self, messages):
+        """
+        Commands are discarded.
+        """
+        pass
+
+    def wait(self, timeout = None):
+        """
+        Wait until the whole recording has been replayed.
+
+        :return: True if the replay is done, False if the timeout expired.
+        """
+        return self.__done.wait(timeout)
+
+    def stop(self):
+        """
+        Stops the replay.
+        """
+        self.__stopped.set()
+        self.__started.set()
+        self.__replay_thread.join()
+
+    def __replay(self):
+        """
+        Dispatch the recorded frames by name, paced by their timestamps.
+        """
+        self.__started.wait()
+        start = None
+        for (timestamp, frames) in read_frames(self.__path):
+            if self.__stopped.is_set():
+                break
+            if self.__speed:
+                if start is None:
+                    start = (timestamp, time.time())
+                delay = start[1] + (timestamp - start[0]) / self.__speed - time.time()
+                # Wait on the stop event, so that stop() does not
+                # have to wait for long gaps in the recording
+                if delay > 0 and self.__stopped.wait(delay):
+                    break
+            handler = self.__handlers.get(frames[0])
+            if handler:
+                handler(*frames)
+        self.__done.set()
@@ -5,7 +5,6 @@
 
 import argparse
 import threading
-import time
 import os
 import sys
 
@@ -16,6 +15,8 @@ from msg import sim_msgs_pb2
 from msg import base_msgs_pb2
 from msg import dev_msgs_pb2
 
+from comm import Dispatcher, Connection, configure_socket, POLL_TIMEOUT
+
 class Control:
     """
     Simulator control API.
@@ -23,6 +24,11 @@ class Control:
     Creates a command publisher and connects it to the simulator.
 
     :param string rtc_file_name: Name of the run-time configuraiton file. This file specifies the parameters for connecting to the simulator.
+    :param dict kwargs: accepts `pub_addr` and `sub_addr` strings, a
+        `timeout` (in seconds) for the connection, after which
+        :py:class:`comm.ConnectionTimeout` is raised (defaults to None,
+        i.e. waiting forever), and `socket_options`
+        (see :py:func:`comm.configure_socket`)
 
     """
 
@@ -38,9 +44,11 @@ class Control:
             # parse any keywords provided, otherwise take default values
             self.__pub_addr = kwargs.get('pub_addr', 'tcp://127.0.0.1:5556')
             self.__sub_addr = kwargs.get('sub_addr', 'tcp://127.0.0.1:5555')
+            self.__socket_options = kwargs.get('socket_options', None)
             #self.__pub_addr = 'tcp://127.0.0.1:5556'
             self.__context = zmq.Context(1)
-            self.__pub = self.__context.socket(zmq.PUB)
+            self.__pub = configure_socket(self.__context.socket(zmq.PUB),
+                                          self.__socket_options, 'pub')
             try:
                 self.__pub.connect(self.__pub_addr)
             except zmq.error.ZMQError:
@@ -50,17 +58,27 @@ class Control:
             #       to prevent program crashes.
             self.__absolute_time = base_msgs_pb2.Time()
             # Create the data update thread
-            self.__connected = False
-            self.__context = zmq.Context(1)
+            self.__connection = Connection('Simulator control')
+            self.__stop = False
             self.__comm_thread = threading.Thread(target=self.__update_readings)
             self.__comm_thread.daemon = True
             self.__lock = threading.Lock()
+            self.__dispatcher = Dispatcher('sim control', strict = False)
+            self.__dispatcher.register_parser('AbsoluteTime', 'Value',
+                                              self.__absolute_time, self.__lock)
             # Connect to the server and start receiving data
             self.__comm_thread.start()
             # Wait for the connection
-            while not self.__connected:
-                time.sleep(1)
-            print('Simulator control connected!')
+            self.__connection.wait(kwargs.get('timeout', None), cleanup = self.__close)
+
+    def __close(self):
+        """
+        Stop the receive thread, and close the sockets and the context.
+        """
+        self.__stop = True
+        self.__comm_thread.join()
+        self.__pub.close()
+        self.__context.term()
 
     def spawn(self,
               obj_type,
@@ -161,7 +179,8 @@ class Control:
         """
         Get data from assisi playground and update local data.
         """
-        self.__sub = self.__context.socket(zmq.SUB)
+        self.__sub = configure_socket(self.__context.socket(zmq.SUB),
+                                      self.__socket_options, 'sub')
         try:
             self.__sub.connect(self.__sub_addr)
         except zmq.error.ZMQError:
@@ -169,17 +188,25 @@ class Control:
             sys.exit(1) # TODO: This might have some issues, as we're within a thread
         self.__sub.setsockopt(zmq.SUBSCRIBE, 'Sim')
 
-        while True:
+        while not self.__stop:
+            if not self.__sub.poll(POLL_TIMEOUT):
+                continue
             [name, dev, cmd, data] = self.__sub.recv_multipart()
-            self.__connected = True
-            if dev == 'AbsoluteTime':
-                if cmd == 'Value':
-                    # Protect write with a lock
-                    # to make sure all data is written before access
-                    with self.__lock:
-                        self.__absolute_time.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for sim control'.format(cmd))
+            self.__dispatcher.dispatch(dev, cmd, data)
+            self.__connection.received(dev)
+
+        self.__sub.close()
+
+    def register_handler(self, dev, cmd, handler):
+        """
+        Register an additional handler for incoming frames.
+
+        :param string dev: Device name (second message frame).
+        :param string cmd: Command name (third message frame), or None to accept any command.
+        :param handler: Callable, invoked from the receive thread as handler(data),
+                        where data is the serialized message.
+        """
+        self.__dispatcher.register(dev, cmd, handler)
 
 
 def spawn_array_from_file(obj_type, array_filename, address, layer_select='all'):